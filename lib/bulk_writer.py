@@ -0,0 +1,244 @@
+import io
+import queue
+import struct
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+
+# Postgres column types of pandas dtypes, as pandas' to_sql creates them
+def sql_type(dtype):
+    """
+    :param dtype: pandas/numpy dtype
+    :return: string, Postgres column type
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(dtype):
+        dt = np.dtype(dtype.numpy_dtype if hasattr(dtype, 'numpy_dtype') else dtype)
+        # Unsigned integers need the next larger signed type
+        size = dt.itemsize * (2 if dt.kind == 'u' else 1)
+        return {1: 'smallint', 2: 'smallint', 4: 'integer'}.get(size, 'bigint')
+    if pd.api.types.is_float_dtype(dtype):
+        return 'real' if np.dtype(dtype).itemsize == 4 else 'double precision'
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return 'timestamp with time zone'
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return 'timestamp without time zone'
+    if pd.api.types.is_timedelta64_dtype(dtype):
+        return 'interval'
+    return 'text'
+
+
+# Big-endian field types of the binary COPY format by numpy dtype kind and size
+_BINARY_TYPES = {('i', 1): '>i2', ('i', 2): '>i2', ('i', 4): '>i4', ('i', 8): '>i8',
+                 ('u', 1): '>i2', ('u', 2): '>i4', ('u', 4): '>i8',
+                 ('f', 4): '>f4', ('f', 8): '>f8', ('b', 1): '?'}
+
+
+def binary_eligible(df):
+    """
+    :param df: dataframe
+    :return: boolean, true if all columns are numeric or boolean without missing values,
+    the frames the vectorized binary encoder handles
+    """
+    for c in df.columns:
+        dt = df[c].dtype
+        if not isinstance(dt, np.dtype) or (dt.kind, dt.itemsize) not in _BINARY_TYPES:
+            return False
+    return not df.isna().values.any()
+
+
+def encode_binary(df, header=True, trailer=True):
+    """
+    Encode a numeric dataframe in the Postgres binary COPY format, all rows at once as a numpy record array.
+    :param df: dataframe, see binary_eligible
+    :param header: boolean, include the file header
+    :param trailer: boolean, include the file trailer
+    :return: bytes
+    """
+    fields = [('n', '>i2')]
+    for i, c in enumerate(df.columns):
+        t = np.dtype(_BINARY_TYPES[(df[c].dtype.kind, df[c].dtype.itemsize)])
+        fields += [(f'l{i}', '>i4'), (f'v{i}', t)]
+    rec = np.empty(len(df), dtype=np.dtype(fields))
+    rec['n'] = len(df.columns)
+    for i, c in enumerate(df.columns):
+        rec[f'l{i}'] = rec.dtype[f'v{i}'].itemsize
+        rec[f'v{i}'] = df[c].values
+    out = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0) if header else b''
+    return out + rec.tobytes() + (struct.pack('>h', -1) if trailer else b'')
+
+
+def encode_csv(df):
+    """
+    :param df: dataframe
+    :return: bytes, CSV rows without header, missing values as \\N (NULL), so that empty strings stay empty strings
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, header=False, index=False, na_rep='\\N')
+    return buf.getvalue().encode('utf-8')
+
+
+class CopyWriter:
+    def __init__(self, engine=None, table_name=None, schema='public', fmt='csv', chunk_size=100000, threaded=True):
+        """
+        Bulk writer streaming dataframes into a table with COPY FROM STDIN instead of multi-row INSERTs.
+        With threaded, the next chunk is encoded in a background thread while the current one is copied.
+        :param engine: sqlalchemy engine
+        :param table_name: string, target table
+        :param schema: string, schema of the table
+        :param fmt: string, 'csv' or 'binary' (numeric frames without missing values, others are sent as CSV)
+        :param chunk_size: int, number of rows per COPY
+        :param threaded: boolean, encode chunks in a background thread
+        :return: None
+        """
+        self.engine = engine
+        self.table_name = table_name
+        self.schema = schema
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.threaded = threaded
+        self.target = f'"{schema}"."{table_name}"'
+
+    def table_exists(self, cur):
+        cur.execute("""SELECT to_regclass(%s) IS NOT NULL;""", (self.target,))
+        return cur.fetchone()[0]
+
+    def create_table(self, cur, df):
+        """
+        Create the table with column types from the dataframe dtypes.
+        :param cur: psycopg2 cursor
+        :param df: dataframe
+        :return: None
+        """
+        cols = ', '.join(f'"{c}" {sql_type(df[c].dtype)}' for c in df.columns)
+        cur.execute(f"""CREATE TABLE {self.target} ({cols});""")
+
+    def drop_indexes(self, cur):
+        """
+        Drop the indexes of the table that do not back a constraint.
+        :param cur: psycopg2 cursor
+        :return: list of index definitions to rebuild them
+        """
+        cur.execute("""SELECT i.indexname, i.indexdef FROM pg_indexes i
+                       WHERE i.schemaname = %s AND i.tablename = %s
+                       AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                                       JOIN pg_namespace n ON n.oid = c.connamespace
+                                       WHERE c.conname = i.indexname AND n.nspname = i.schemaname);""",
+                    (self.schema, self.table_name))
+        rows = cur.fetchall()
+        for name, _ in rows:
+            cur.execute(f"""DROP INDEX "{self.schema}"."{name}";""")
+        return [d for _, d in rows]
+
+    def chunks(self, df, binary):
+        for i in range(0, len(df), self.chunk_size):
+            part = df.iloc[i:i + self.chunk_size]
+            yield encode_binary(part) if binary else encode_csv(part)
+
+    def pipeline(self, df, binary):
+        """
+        Encoded chunks, produced in a background thread at most two chunks ahead of the copy.
+        When the generator is closed early, e.g., by a failed COPY, the producer is stopped.
+        """
+        if not self.threaded:
+            yield from self.chunks(df, binary)
+            return
+        q = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item):
+            # Give up when the consumer is gone instead of blocking on a full queue
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for data in self.chunks(df, binary):
+                    if not put(data):
+                        return
+            except Exception as e:
+                put(e)
+            put(None)
+
+        t = threading.Thread(target=produce, daemon=True)
+        t.start()
+        try:
+            while True:
+                data = q.get()
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+        finally:
+            stop.set()
+            t.join()
+
+    def write(self, df, if_exists='append', rebuild_indexes=False):
+        """
+        Write a dataframe to the table in one transaction.
+        :param df: dataframe, the index is not written
+        :param if_exists: string, 'append' (create the table if missing), 'replace', or 'fail', as in to_sql
+        :param rebuild_indexes: boolean, drop the table indexes before the load and rebuild them after
+        :return: None
+        """
+        start = time.time()
+        binary = (self.fmt == 'binary') and binary_eligible(df)
+        cols = ', '.join(f'"{c}"' for c in df.columns)
+        options = '(FORMAT binary)' if binary else "(FORMAT csv, NULL '\\N')"
+        conn = self.engine.raw_connection()
+        try:
+            cur = conn.cursor()
+            exists = self.table_exists(cur)
+            if exists and (if_exists == 'fail'):
+                raise ValueError(f"Table {self.target} already exists.")
+            if exists and (if_exists == 'replace'):
+                cur.execute(f"""DROP TABLE {self.target};""")
+                exists = False
+            if not exists:
+                self.create_table(cur, df)
+            index_defs = self.drop_indexes(cur) if rebuild_indexes else []
+            chunks = self.pipeline(df, binary)
+            try:
+                for data in chunks:
+                    cur.copy_expert(f"""COPY {self.target} ({cols}) FROM STDIN WITH {options};""", io.BytesIO(data))
+            finally:
+                chunks.close()
+            for d in index_defs:
+                cur.execute(d)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        print(f'{len(df)} rows written to {self.target} in {time.time() - start:.1f} seconds.')
+
+
+def copy2db(df, table_name, engine, schema='public', if_exists='append', fmt='csv', chunk_size=100000,
+            threaded=True, rebuild_indexes=False):
+    """
+    Write a dataframe to a database table with COPY, a replacement of
+    df.to_sql(table_name, engine, schema=schema, index=False, if_exists=if_exists, method='multi').
+    :param df: dataframe, the index is not written
+    :param table_name: string, target table
+    :param engine: sqlalchemy engine
+    :param schema: string, schema of the table
+    :param if_exists: string, 'append', 'replace', or 'fail'
+    :param fmt: string, 'csv' or 'binary'
+    :param chunk_size: int, number of rows per COPY
+    :param threaded: boolean, encode chunks in a background thread
+    :param rebuild_indexes: boolean, drop the table indexes before the load and rebuild them after
+    :return: None
+    """
+    writer = CopyWriter(engine=engine, table_name=table_name, schema=schema, fmt=fmt,
+                        chunk_size=chunk_size, threaded=threaded)
+    writer.write(df, if_exists=if_exists, rebuild_indexes=rebuild_indexes)
@@ -2,6 +2,8 @@ import torch
 import torch_geometric
 import networkx as nx
 import pandas as pd
+import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 # import umap
 import matplotlib.pyplot as plt
@@ -166,6 +168,51 @@ def generic_weighted_projected_graph(B, nodes, weight_function=None, num_cpus=4)
     return G
 
 
+def sparse_weighted_projection(df_edges, u_col='uid', v_col='zone', weight_col='weight',
+                               attrs=('birth_se', 'birth_other', 'pop'), chunk_size=2000):
+    """
+    Project a bipartite visitor-zone graph onto the zones with sparse matrix products.
+    For each pair of zones sharing at least one visitor, the edge weights and the weighted attributes
+    of both zones' edges to their shared visitors are summed, i.e., for the pair (u, v),
+    sum over shared visitors n of w(u, n) * attr(u, n) + w(v, n) * attr(v, n),
+    the same sums as my_weight/my_weight_seg over generic_weighted_projected_graph.
+    :param df_edges: dataframe, edges of the bipartite graph, one row per (visitor, zone)
+    (for duplicates, the last row is kept as in nx.from_pandas_edgelist)
+    :param u_col: string, column of visitors
+    :param v_col: string, column of zones
+    :param weight_col: string, column of edge weight
+    :param attrs: tuple of strings, edge attributes to sum weighted by the edge weight
+    :param chunk_size: int, number of zones per block of the products, bounds memory use
+    :return: a dataframe of zone pairs (u < v in order of appearance) with shared visitor count, weight, and attrs
+    """
+    df = df_edges.drop_duplicates(subset=[u_col, v_col], keep='last')
+    ui, _ = pd.factorize(df[u_col])
+    zi, zones = pd.factorize(df[v_col])
+    shape = (ui.max() + 1 if len(ui) > 0 else 0, len(zones))
+    w = df[weight_col].values.astype(np.float64)
+    X = sparse.csc_matrix((np.ones(len(df)), (ui, zi)), shape=shape)
+    mats = [sparse.csc_matrix((w, (ui, zi)), shape=shape)] + \
+           [sparse.csc_matrix((w * df[a].values.astype(np.float64), (ui, zi)), shape=shape) for a in attrs]
+    X_t = X.T.tocsr()
+
+    rstl = []
+    for s in tqdm(range(0, len(zones), chunk_size)):
+        blk = slice(s, min(s + chunk_size, len(zones)))
+        shared = (X_t[blk, :] @ X).tocoo()
+        keep = shared.col > shared.row + s
+        r, c = shared.row[keep], shared.col[keep]
+        cols = {'u': r + s, 'v': c, 'visitors': shared.data[keep].astype(np.int64)}
+        for name, M in zip((weight_col,) + tuple(attrs), mats):
+            S = (M[:, blk].T @ X + X_t[blk, :] @ M).tocsr()
+            cols[name] = np.asarray(S[r, c]).ravel() if len(r) > 0 else np.empty(0)
+        rstl.append(pd.DataFrame(cols))
+    edges = pd.concat(rstl) if len(rstl) > 0 else pd.DataFrame(columns=['u', 'v', 'visitors', weight_col] + list(attrs))
+    edges = edges.sort_values(['u', 'v']).reset_index(drop=True)
+    edges.loc[:, 'u'] = zones[edges['u'].values.astype(np.int64)]
+    edges.loc[:, 'v'] = zones[edges['v'].values.astype(np.int64)]
+    return edges
+
+
 def embeddings_umap(emb=None, labels=None, field_label=None):
     """
     :param emb: numpy array, n x 64 array of embeddings
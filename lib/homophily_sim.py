@@ -0,0 +1,171 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def tag_categorization(tag, x):
+    """
+    Similarity category of a candidate POI tag to the visited POI tag.
+    :param tag: string, tag of the visited POI
+    :param x: string, tag of the candidate POI
+    :return: 1 same tag, 2 same tag family, 3 office/craft, 4 both shop-like, 0 otherwise
+    """
+    if x == tag:
+        return 1
+    if ('(' in tag) & ('(' in x):
+        if tag.split(' (')[0] == x.split(' (')[0]:
+            return 2
+    if (tag in ('Office', 'Craft')) & (x in ('Office', 'Craft')):
+        return 3
+    if ('(s)' in tag) | (tag == 'Shop'):
+        if ('(s)' in x) | (x == 'Shop'):
+            return 4
+    return 0
+
+
+def tag_category_matrix(tags):
+    """
+    :param tags: array of POI tags
+    :return: int8 matrix, [i, j] is the category of tag j for a visit to tag i
+    """
+    return np.array([[tag_categorization(t, x) for x in tags] for t in tags], dtype=np.int8)
+
+
+class DistanceFreeSimulator:
+    def __init__(self, pois=None, df_d=None, draws=1000, pool_size=100, seed=0):
+        """
+        Distance-free homophily simulation: a visit to a POI is shifted to POIs of a similar tag
+        at distances from home drawn from the distance-decay distribution.
+        Per home, POIs are bucketed once by 1-km ring and tag, and all draws are vectorized.
+        :param pois: PoiIndex with zone membership
+        :param df_d: dataframe, distance decay with d (km) and fd (probability)
+        :param draws: int, number of distance draws per visit
+        :param pool_size: int, number of simulated destinations per visit
+        :param seed: int, random seed
+        :return: None
+        """
+        self.pois = pois
+        self.rings = df_d['d'].values.astype(np.int64)
+        self.p = df_d['fd'].values / df_d['fd'].values.sum()
+        self.n_rings = self.rings.max() + 1
+        self.r_max = (self.rings.max() + 0.5) * 1000
+        self.draws = draws
+        self.pool_size = pool_size
+        self.seed = seed
+        self.n_tags = len(pois.tags)
+        self.tag_index = pd.Index(pois.tags)
+        self.cat = tag_category_matrix(pois.tags)
+
+    def home_buckets(self, x_h, y_h):
+        """
+        POIs of each (1-km ring, tag) bucket around a home.
+        :param x_h: float, home x in EPSG:3006
+        :param y_h: float, home y in EPSG:3006
+        :return: POI positions sorted by bucket, bucket offsets, and bucket counts (n_rings x n_tags)
+        """
+        ind, dist = self.pois.tree.query_radius([[y_h, x_h]], r=self.r_max, return_distance=True)
+        ind, dist = ind[0], dist[0]
+        cell = np.rint(dist / 1000).astype(np.int64) * self.n_tags + self.pois.tag_code[ind]
+        order = np.argsort(cell, kind='stable')
+        counts = np.bincount(cell, minlength=self.n_rings * self.n_tags)
+        offsets = np.cumsum(counts) - counts
+        return ind[order], offsets, counts.reshape(self.n_rings, self.n_tags)
+
+    def simulate_home(self, tags, x_h, y_h, rng):
+        """
+        Simulated destinations of the visits of one home.
+        :param tags: array of tag codes of the visited POIs
+        :param x_h: float, home x in EPSG:3006
+        :param y_h: float, home y in EPSG:3006
+        :param rng: numpy Generator
+        :return: int32 matrix (visits x pool_size) of hex codes, -1 where no candidate is found
+        """
+        m = len(tags)
+        out = np.full((m, self.pool_size), -1, dtype=np.int32)
+        ind, offsets, counts = self.home_buckets(x_h, y_h)
+
+        # Distance rings drawn for each visit
+        drawn = rng.choice(self.rings, size=(m, self.draws), p=self.p)
+        incl = np.zeros((m, self.n_rings), dtype=np.int64)
+        incl[np.repeat(np.arange(m), self.draws), drawn.ravel()] = 1
+        avail = incl @ counts
+        cats = self.cat[tags]
+
+        # The most similar tag category with candidates
+        tot = np.stack([(avail * (cats == c)).sum(axis=1) for c in (1, 2, 3, 4)], axis=1)
+        has = tot > 0
+        sel = np.where(has.any(axis=1), has.argmax(axis=1) + 1, 0)
+
+        # Sample POIs uniformly from the candidates: a bucket by its size, then a POI within it
+        for i in np.flatnonzero(sel):
+            w = (incl[i][:, None] * counts * (cats[i] == sel[i])[None, :]).ravel()
+            cum = np.cumsum(w)
+            u = rng.random(self.pool_size) * cum[-1]
+            b = np.searchsorted(cum, u, side='right')
+            k = (u - (cum[b] - w[b])).astype(np.int64)
+            out[i] = self.pois.hex_code[ind[offsets[b] + np.minimum(k, w[b] - 1)]]
+        return out
+
+    def simulate(self, data, key=0):
+        """
+        Simulate the visits of a chunk of users, rows are grouped by home location.
+        :param data: dataframe, visits with Tag and home coordinates x_h, y_h
+        :param key: int or tuple of ints, chunk key combined with the seed so that each chunk is reproducible
+        :return: int32 matrix (rows of data x pool_size) of hex codes, -1 where no candidate is found
+        """
+        rng = np.random.default_rng([self.seed] + list(np.atleast_1d(key)))
+        out = np.full((len(data), self.pool_size), -1, dtype=np.int32)
+        tags = self.tag_index.get_indexer(data['Tag'].values)
+        x_h, y_h = data['x_h'].values, data['y_h'].values
+        valid = ~(np.isnan(x_h) | np.isnan(y_h)) & (tags >= 0)
+        homes = pd.MultiIndex.from_arrays([x_h, y_h]).factorize()[0]
+        rows = np.flatnonzero(valid)
+        rows = rows[np.argsort(homes[rows], kind='stable')]
+        bounds = np.flatnonzero(np.r_[True, homes[rows][1:] != homes[rows][:-1], True])
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            r = rows[s:e]
+            out[r] = self.simulate_home(tags[r], x_h[r[0]], y_h[r[0]], rng)
+        return out
+
+    def fingerprint(self, data, group_col='iter_num'):
+        """
+        Hash of everything the simulated groups depend on: the seed and sizes, the distance decay,
+        the POI index, and the visits with their group layout.
+        :param data: dataframe, visits with Tag, x_h, y_h, and the group column
+        :param group_col: string, column of iteration group
+        :return: string, md5 hex digest
+        """
+        h = hashlib.md5()
+        h.update(f'{self.seed}|{self.draws}|{self.pool_size}|{self.pois.key}'.encode())
+        h.update(np.ascontiguousarray(self.rings).tobytes())
+        h.update(np.ascontiguousarray(self.p).tobytes())
+        h.update(pd.util.hash_pandas_object(data[['Tag', 'x_h', 'y_h', group_col]], index=False).values.tobytes())
+        return h.hexdigest()
+
+    def simulate_groups(self, data, group_col='iter_num', path=None, worker=None):
+        """
+        Simulate iteration groups one by one, saving each to disk so that an interrupted run resumes
+        from the first missing group. Groups are saved in a subdirectory keyed by the fingerprint of the inputs,
+        so that groups simulated from other inputs are never reused.
+        :param data: dataframe, visits with Tag, x_h, y_h, and the group column
+        :param group_col: string, column of iteration group
+        :param path: string, directory of the saved groups
+        :param worker: function(data, key) -> matrix, e.g., a parallel wrapper of self.simulate
+        :return: int32 matrix (rows of data x pool_size) of hex codes
+        """
+        worker = self.simulate if worker is None else worker
+        path = os.path.join(path, self.fingerprint(data, group_col=group_col)[:16])
+        os.makedirs(path, exist_ok=True)
+        out = np.full((len(data), self.pool_size), -1, dtype=np.int32)
+        for n, idx in data.groupby(group_col).indices.items():
+            file = os.path.join(path, f'{group_col}_{n}.npy')
+            if os.path.exists(file):
+                print(f'Group {n} loaded.')
+                out[idx] = np.load(file)
+                continue
+            print(f'Processing group {n}...')
+            out[idx] = worker(data.iloc[idx], n)
+            np.save(file + '.tmp.npy', out[idx])
+            os.replace(file + '.tmp.npy', file)
+        return out
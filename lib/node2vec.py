@@ -0,0 +1,229 @@
+import os
+import hashlib
+import numpy as np
+import networkx as nx
+from tqdm import tqdm
+from p_tqdm import p_map
+
+
+class WalkEngine:
+    def __init__(self, G=None, weight='weight'):
+        """
+        Biased (node2vec) random walks on a weighted graph stored once as CSR arrays.
+        First-order steps are drawn by inverse CDF over the cumulative edge weights of each node,
+        and p/q-biased second-order steps by rejection sampling, for all walkers at once.
+        :param G: networkx graph with edge weights
+        :param weight: string, edge attribute of weight
+        :return: None
+        """
+        self.nodes = list(G.nodes())
+        to_csr = nx.to_scipy_sparse_array if hasattr(nx, 'to_scipy_sparse_array') else nx.to_scipy_sparse_matrix
+        A = to_csr(G, nodelist=self.nodes, weight=weight, format='csr')
+        A.sort_indices()
+        self.n = len(self.nodes)
+        self.indptr = A.indptr.astype(np.int64)
+        self.indices = A.indices.astype(np.int32)
+        self.cum = np.r_[0, np.cumsum(A.data.astype(np.float64))]
+        self.degree = np.diff(self.indptr)
+        # Sorted (row, col) keys to test edges between arbitrary node pairs
+        self.edge_keys = np.repeat(np.arange(self.n, dtype=np.int64), self.degree) * self.n + self.indices
+
+    def has_edge(self, u, v):
+        """
+        :param u: array of node positions
+        :param v: array of node positions
+        :return: boolean array, true where the edge (u, v) exists
+        """
+        keys = u.astype(np.int64) * self.n + v
+        pos = np.minimum(np.searchsorted(self.edge_keys, keys), len(self.edge_keys) - 1)
+        return self.edge_keys[pos] == keys if len(self.edge_keys) > 0 else np.zeros(len(keys), dtype=bool)
+
+    def first_order_step(self, cur, rng):
+        """
+        Draw a neighbor of each current node with probability proportional to the edge weight.
+        :param cur: array of current node positions
+        :param rng: numpy Generator
+        :return: array of next node positions (the current node where it has no neighbor)
+        """
+        lo, hi = self.indptr[cur], self.indptr[cur + 1]
+        target = self.cum[lo] + rng.random(len(cur)) * (self.cum[hi] - self.cum[lo])
+        pos = np.clip(np.searchsorted(self.cum, target, side='right') - 1, lo, np.maximum(hi - 1, lo))
+        return np.where(hi > lo, self.indices[np.minimum(pos, len(self.indices) - 1)], cur)
+
+    def walk(self, starts, num_steps, p, q, rng):
+        """
+        :param starts: array of start node positions, one walk per start
+        :param num_steps: int, walk length including the start node
+        :param p: float, return parameter
+        :param q: float, in-out parameter
+        :param rng: numpy Generator
+        :return: int32 array (walks x num_steps) of node positions
+        """
+        walks = np.empty((len(starts), num_steps), dtype=np.int32)
+        walks[:, 0] = starts
+        if num_steps > 1:
+            walks[:, 1] = self.first_order_step(walks[:, 0], rng)
+        a_max = max(1 / p, 1, 1 / q)
+        for t in range(2, num_steps):
+            prev, cur = walks[:, t - 2], walks[:, t - 1]
+            if (p == 1) and (q == 1):
+                walks[:, t] = self.first_order_step(cur, rng)
+                continue
+            # Propose by weight, accept with the node2vec bias relative to its maximum
+            todo = np.arange(len(starts))
+            while len(todo) > 0:
+                x = self.first_order_step(cur[todo], rng)
+                alpha = np.where(x == prev[todo], 1 / p, np.where(self.has_edge(x, prev[todo]), 1, 1 / q))
+                acc = (rng.random(len(todo)) * a_max < alpha) | (self.degree[cur[todo]] == 0)
+                walks[todo[acc], t] = x[acc]
+                todo = todo[~acc]
+        return walks
+
+    def random_walks(self, num_walks, num_steps, p=1, q=1, seed=0, num_cpus=1):
+        """
+        Walks from every node, num_walks times, in shuffled order per iteration.
+        The walks are split into chunks run in parallel processes, each with its own seed.
+        :param num_walks: int, number of iterations over all nodes
+        :param num_steps: int, walk length
+        :param p: float, return parameter
+        :param q: float, in-out parameter
+        :param seed: int, random seed
+        :param num_cpus: int, number of processes
+        :return: int32 array (num_walks * nodes x num_steps) of node positions
+        """
+        ss = np.random.SeedSequence(seed)
+        rng = np.random.default_rng(ss)
+        starts = np.concatenate([rng.permutation(self.n) for _ in range(num_walks)]).astype(np.int32)
+        chunks = np.array_split(starts, num_cpus)
+        seeds = ss.spawn(num_cpus)
+        if num_cpus == 1:
+            return self.walk(chunks[0], num_steps, p, q, np.random.default_rng(seeds[0]))
+        rstl = p_map(lambda c, s: self.walk(c, num_steps, p, q, np.random.default_rng(s)),
+                     chunks, seeds, num_cpus=num_cpus)
+        return np.concatenate(rstl)
+
+
+def skipgram_pairs(walks, window_size):
+    """
+    Positive skip-gram pairs of walks: every pair of tokens at most window_size steps apart,
+    taken from a strided window view of the walks instead of a loop over positions.
+    :param walks: int array (walks x steps) of token ids, 0 is not a token
+    :param window_size: int, maximum distance between the target and the context
+    :return: arrays of targets and contexts, one per pair of positions
+    """
+    walks = np.asarray(walks)
+    w = max(min(window_size, walks.shape[1] - 1), 0)
+    padded = np.pad(walks, ((0, 0), (0, w)), constant_values=0)
+    win = np.lib.stride_tricks.sliding_window_view(padded, w + 1, axis=1)[:, :walks.shape[1]]
+    context = win[..., 1:]
+    target = np.broadcast_to(win[..., :1], context.shape)
+    keep = (context > 0) & (target > 0)
+    return target[keep], context[keep]
+
+
+class SkipGramExamples:
+    def __init__(self, walks=None, vocabulary_size=None, window_size=5, num_negative_samples=1,
+                 chunk_size=10000, seed=0):
+        """
+        Weighted skip-gram examples produced chunk by chunk of walks, so that all the examples are never held in memory.
+        As in keras skipgrams, each pair of positions gives two positive examples (one per direction)
+        and num_negative_samples negatives per positive, with the target taken from the positives;
+        the negative contexts are drawn from the unigram distribution of the walks raised to the power 0.75.
+        Within a chunk, (target, context) is ordered and duplicated examples are merged with their count as weight.
+        :param walks: int array (walks x steps) of token ids, can be memory-mapped
+        :param vocabulary_size: int, number of tokens including 0 ("NA")
+        :param window_size: int, maximum distance between the target and the context
+        :param num_negative_samples: int, number of negatives per positive example
+        :param chunk_size: int, number of walks per chunk
+        :param seed: int, random seed
+        :return: None
+        """
+        self.walks = walks
+        self.vocabulary_size = vocabulary_size
+        self.window_size = window_size
+        self.num_negative_samples = num_negative_samples
+        self.chunk_size = chunk_size
+        self.seed = seed
+        counts = np.zeros(vocabulary_size, dtype=np.int64)
+        for i in range(0, len(walks), chunk_size):
+            counts += np.bincount(np.asarray(walks[i:i + chunk_size]).ravel(), minlength=vocabulary_size)
+        counts[0] = 0
+        self.unigram_cum = np.cumsum(counts ** 0.75)
+
+    def __len__(self):
+        return -(-len(self.walks) // self.chunk_size)
+
+    def negatives(self, n, rng):
+        """
+        :param n: int, number of draws
+        :param rng: numpy Generator
+        :return: int array of token ids drawn from the unigram^0.75 distribution
+        """
+        u = rng.random(n) * self.unigram_cum[-1]
+        return np.searchsorted(self.unigram_cum, u, side='right')
+
+    def chunk(self, k):
+        """
+        :param k: int, chunk number
+        :return: arrays of targets, contexts, labels (int32), and weights (float32), shuffled
+        """
+        rng = np.random.default_rng([self.seed, k])
+        t, c = skipgram_pairs(self.walks[k * self.chunk_size:(k + 1) * self.chunk_size], self.window_size)
+        n_neg = 2 * len(t) * self.num_negative_samples
+        targets = np.concatenate([t, c, rng.choice(np.r_[t, c], size=n_neg) if n_neg > 0 else t[:0]])
+        contexts = np.concatenate([c, t, self.negatives(n_neg, rng)])
+        labels = np.r_[np.ones(2 * len(t), dtype=np.int64), np.zeros(n_neg, dtype=np.int64)]
+        lo, hi = np.minimum(targets, contexts).astype(np.int64), np.maximum(targets, contexts).astype(np.int64)
+        keep = lo != hi
+        keys = (lo[keep] * self.vocabulary_size + hi[keep]) * 2 + labels[keep]
+        keys, weights = np.unique(keys, return_counts=True)
+        order = rng.permutation(len(keys))
+        keys, weights = keys[order], weights[order]
+        pair = keys // 2
+        return ((pair // self.vocabulary_size).astype(np.int32), (pair % self.vocabulary_size).astype(np.int32),
+                (keys % 2).astype(np.int32), weights.astype(np.float32))
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.chunk(k)
+
+    def fingerprint(self):
+        """
+        :return: string, md5 hex digest of the walks and the example parameters
+        """
+        h = hashlib.md5()
+        h.update(f'{self.walks.shape}|{self.vocabulary_size}|{self.window_size}|{self.num_negative_samples}|'
+                 f'{self.chunk_size}|{self.seed}'.encode())
+        for i in range(0, len(self.walks), self.chunk_size):
+            h.update(np.ascontiguousarray(self.walks[i:i + self.chunk_size]).tobytes())
+        return h.hexdigest()
+
+    def save_shards(self, path):
+        """
+        Write the examples to disk one shard per chunk, so that training can stream them from disk.
+        Shards go to a subdirectory keyed by the fingerprint of the walks and parameters; existing shards
+        there are kept, so an interrupted run resumes from the first missing shard.
+        :param path: string, root directory of the shards
+        :return: string, directory of the shards of these examples
+        """
+        path = os.path.join(path, self.fingerprint()[:16])
+        os.makedirs(path, exist_ok=True)
+        for k in tqdm(range(len(self)), desc='Writing skip-gram shards'):
+            file = os.path.join(path, f'shard_{k:05d}.npz')
+            if os.path.exists(file):
+                continue
+            targets, contexts, labels, weights = self.chunk(k)
+            np.savez(file + '.tmp.npz', targets=targets, contexts=contexts, labels=labels, weights=weights)
+            os.replace(file + '.tmp.npz', file)
+        return path
+
+    @staticmethod
+    def read_shards(path, num_shards):
+        """
+        :param path: string, directory of the shards, as returned by save_shards
+        :param num_shards: int, number of shards, i.e., len() of the examples
+        :return: generator of (targets, contexts, labels, weights), one per shard
+        """
+        for k in range(num_shards):
+            with np.load(os.path.join(path, f'shard_{k:05d}.npz')) as d:
+                yield d['targets'], d['contexts'], d['labels'], d['weights']
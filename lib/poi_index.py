@@ -0,0 +1,185 @@
+import os
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import joblib
+from joblib import Parallel, delayed
+from shapely.strtree import STRtree
+from sklearn.neighbors import KDTree
+
+
+ROOT_dir = Path(__file__).parent.parent
+
+
+def poi_table_hash(engine, table='built_env.pois'):
+    """
+    Content hash of the POI table computed on the database side, so that a cached index
+    can be validated without transferring the POIs.
+    :param engine: sqlalchemy engine
+    :param table: string, schema-qualified POI table with osm_id, "Tag", and geom
+    :return: string, md5 hex digest
+    """
+    sql = f"""SELECT md5(string_agg(md5(osm_id::text || '|' || coalesce("Tag", '') || '|' || ST_AsText(geom)),
+                                    '' ORDER BY osm_id)) AS h
+              FROM {table};"""
+    return pd.read_sql(sql=sql, con=engine)['h'].values[0]
+
+
+def zones_hash(zones, label_col='hex_id'):
+    """
+    :param zones: geodataframe, spatial units with a label column and geometry
+    :param label_col: string, column of zone label
+    :return: string, md5 hex digest of the labels and geometries
+    """
+    h = hashlib.md5()
+    h.update(pd.util.hash_pandas_object(zones[label_col], index=False).values.tobytes())
+    h.update(b''.join(shapely.to_wkb(np.array(list(zones.geometry.values)))))
+    h.update(str(zones.crs).encode())
+    return h.hexdigest()
+
+
+def _nearest_chunk(tree, points, r):
+    dist, ind = tree.query(points, k=1, return_distance=True)
+    num = tree.query_radius(points, r=r, count_only=True).astype(np.int32)
+    found = num > 0
+    return np.where(found, ind[:, 0], -1), np.where(found, dist[:, 0], np.nan), num
+
+
+def nearest_within(tree, points, r=300, chunk_size=500000, n_jobs=1):
+    """
+    Nearest neighbour of each point within a radius, with the number of neighbours within the radius.
+    Replaces query_radius(..., sort_results=True) when only the first hit and the count are needed:
+    a k=1 query and a count_only query return flat arrays instead of one array per point.
+    :param tree: sklearn KDTree
+    :param points: 2D array of coordinates in the order of the tree, e.g., (y, x)
+    :param r: float, search radius
+    :param chunk_size: int, number of points per query batch
+    :param n_jobs: int, number of threads querying batches in parallel (the tree queries release the GIL)
+    :return: arrays of neighbour position (-1 if none), distance (NaN if none), and neighbour count
+    """
+    points = np.asarray(points, dtype=np.float64)
+    bounds = range(0, len(points), chunk_size)
+    if n_jobs == 1:
+        rstl = [_nearest_chunk(tree, points[i:i + chunk_size], r) for i in bounds]
+    else:
+        rstl = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(_nearest_chunk)(tree, points[i:i + chunk_size], r) for i in bounds)
+    if len(rstl) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int32)
+    return tuple(np.concatenate(a) for a in zip(*rstl))
+
+
+class PoiIndex:
+    def __init__(self, cache_dir=os.path.join(ROOT_dir, 'dbs', 'poi_index')):
+        """
+        POIs projected to EPSG:3006 with their tag codes, zone membership, and KD-tree, built once
+        and cached on disk as a single memory-mappable file keyed by the hash of the POI table.
+        :param cache_dir: string, directory of the cached indexes
+        :return: None
+        """
+        self.cache_dir = cache_dir
+        self.key = None
+        self.osm_id = None
+        self.x = None
+        self.y = None
+        self.tags = None
+        self.tag_code = None
+        self.hexes = None
+        self.hex_code = None
+        self.tree = None
+
+    def build(self, gdf_pois, zones=None, label_col='hex_id'):
+        """
+        Build the index from a POI geodataframe.
+        :param gdf_pois: geodataframe, POIs with osm_id, Tag, and point geometry
+        :param zones: geodataframe, spatial units to find the zone of each POI, optional
+        :param label_col: string, column of zone label in zones, e.g., the mixed hexagon label
+        :return: None
+        """
+        gdf_pois = gdf_pois.to_crs(3006)
+        self.osm_id = gdf_pois['osm_id'].values
+        self.x = gdf_pois.geometry.x.values.astype(np.float64)
+        self.y = gdf_pois.geometry.y.values.astype(np.float64)
+        tag_code, tags = pd.factorize(gdf_pois['Tag'], sort=True)
+        self.tag_code, self.tags = tag_code.astype(np.int16), np.asarray(tags, dtype=object)
+        if zones is not None:
+            # Zone of each POI in a single bulk query, POIs outside any zone are dropped as in an inner spatial join
+            zones = zones.to_crs(3006)
+            tree = STRtree(np.array(list(zones.geometry.values)))
+            pi, zi = tree.query(shapely.points(self.x, self.y), predicate='intersects')
+            order = np.lexsort((zi, pi))
+            pi, zi = pi[order], zi[order]
+            first = np.r_[True, pi[1:] != pi[:-1]]
+            pi, zi = pi[first], zi[first]
+            hex_code, hexes = pd.factorize(zones[label_col].values[zi], sort=True)
+            self.hex_code, self.hexes = hex_code.astype(np.int32), np.asarray(hexes, dtype=object)
+            self.osm_id, self.x, self.y, self.tag_code = self.osm_id[pi], self.x[pi], self.y[pi], self.tag_code[pi]
+        self.tree = KDTree(np.column_stack([self.y, self.x]), metric="euclidean")
+        print(f"POI index built: {len(self.x)} POIs, {len(self.tags)} tags.")
+
+    def save(self, path):
+        """
+        :param path: string, file of the cached index
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump({k: getattr(self, k) for k in ('osm_id', 'x', 'y', 'tags', 'tag_code',
+                                                   'hexes', 'hex_code', 'tree')}, path)
+
+    def read(self, path):
+        """
+        Memory-map a cached index, the arrays and the KD-tree are not copied into memory.
+        :param path: string, file of the cached index
+        :return: None
+        """
+        for k, v in joblib.load(path, mmap_mode='r').items():
+            setattr(self, k, v)
+        print(f"POI index loaded: {len(self.x)} POIs, {len(self.tags)} tags.")
+
+    def load(self, engine, zones=None, label_col='hex_id', table='built_env.pois'):
+        """
+        Load the index from the cache if the POI table (and zones) are unchanged, otherwise build and cache it.
+        :param engine: sqlalchemy engine
+        :param zones: geodataframe, spatial units to find the zone of each POI, optional
+        :param label_col: string, column of zone label in zones
+        :param table: string, schema-qualified POI table
+        :return: None
+        """
+        key = poi_table_hash(engine, table=table)
+        if zones is not None:
+            key = hashlib.md5((key + zones_hash(zones, label_col=label_col) + label_col).encode()).hexdigest()
+        self.key = key
+        path = os.path.join(self.cache_dir, f'pois_{key}.joblib')
+        if os.path.exists(path):
+            self.read(path)
+            return
+        print('Build POI index...')
+        gdf_pois = gpd.GeoDataFrame.from_postgis(sql=f"""SELECT osm_id, "Tag", geom FROM {table};""", con=engine)
+        self.build(gdf_pois, zones=zones, label_col=label_col)
+        self.save(path)
+
+    def frame(self, hex_col='hex_s'):
+        """
+        :param hex_col: string, output column of zone label
+        :return: a dataframe of osm_id, Tag, x, y (and zone label), rows in the order of the KD-tree
+        """
+        tag = np.where(self.tag_code >= 0, self.tags[np.maximum(self.tag_code, 0)], None)
+        df = pd.DataFrame({'osm_id': self.osm_id, 'Tag': tag, 'x': self.x, 'y': self.y})
+        if self.hex_code is not None:
+            df.loc[:, hex_col] = self.hexes[self.hex_code]
+        return df
+
+    def match(self, x, y, r=300, chunk_size=500000, n_jobs=1):
+        """
+        Nearest POI of each stop within r meters.
+        :param x: array of stop x coordinates in EPSG:3006
+        :param y: array of stop y coordinates in EPSG:3006
+        :param r: float, search radius in meters
+        :param chunk_size: int, number of stops per query batch
+        :param n_jobs: int, number of stop batches queried in parallel
+        :return: arrays of POI position (-1 if none), distance (NaN if none), and number of POIs within r
+        """
+        return nearest_within(self.tree, np.column_stack([y, x]), r=r, chunk_size=chunk_size, n_jobs=n_jobs)
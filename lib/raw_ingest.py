@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import multiprocessing
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import Transformer
+from tqdm import tqdm
+
+
+ROOT_dir = Path(__file__).parent.parent
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+from stay_loader import uid_partition
+
+
+# Arrow types of the columns of the raw daily files and of the derived UTM coordinates
+RAW_FIELDS = {'timestamp': pa.int64(), 'device_aid': pa.string(), 'latitude': pa.float64(),
+              'longitude': pa.float64(), 'location_method': pa.string(),
+              'utm_x': pa.float64(), 'utm_y': pa.float64()}
+
+
+def utm_zone(lat, lng):
+    """
+    UTM zone number of each point, as utm.latlon_to_zone_number, including the Norway and Svalbard exceptions.
+    :param lat: array of latitudes
+    :param lng: array of longitudes
+    :return: int array of zone numbers
+    """
+    lat, lng = np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64)
+    lng = (lng % 360 + 540) % 360 - 180
+    zone = ((lng + 180) / 6).astype(np.int64) + 1
+    zone = np.where((lat >= 56) & (lat < 64) & (lng >= 3) & (lng < 12), 32, zone)
+    svalbard = (lat >= 72) & (lat <= 84) & (lng >= 0) & (lng < 42)
+    return np.where(svalbard, np.array([31, 33, 35, 37])[np.searchsorted([9, 21, 33], lng, side='right')], zone)
+
+
+@lru_cache(maxsize=None)
+def utm_transformer(epsg):
+    """
+    :param epsg: int, EPSG code of a WGS 84 / UTM zone, e.g., 32633
+    :return: pyproj Transformer from lng/lat, created once per zone and process
+    """
+    return Transformer.from_crs(4326, epsg, always_xy=True)
+
+
+def latlon_to_utm(lat, lng):
+    """
+    UTM easting and northing of each point in its own zone, as utm.from_latlon row by row,
+    with one vectorized pyproj transform per zone present.
+    :param lat: array of latitudes
+    :param lng: array of longitudes
+    :return: arrays of utm_x and utm_y
+    """
+    lat, lng = np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64)
+    epsg = utm_zone(lat, lng) + np.where(lat < 0, 32700, 32600)
+    x, y = np.empty(len(lat)), np.empty(len(lat))
+    for code in np.unique(epsg):
+        idx = np.flatnonzero(epsg == code)
+        x[idx], y[idx] = utm_transformer(int(code)).transform(lng[idx], lat[idx])
+    return x, y
+
+
+# Ingestor of the pool workers, set once per process
+_worker = {}
+
+
+def _init_worker(ingestor):
+    _worker['ingestor'] = ingestor
+
+
+def _ingest_task(task):
+    return _worker['ingestor'].ingest_file(*task)
+
+
+class RawIngestor:
+    def __init__(self, raw_folder=None, out_folder=None, columns=None, num_buckets=100, chunk_size=2000000,
+                 devices=None, num_cpus=None):
+        """
+        Convert the raw daily .gz TSV files of device locations into a Parquet dataset partitioned as
+        bucket=XX/month=MM/day=DD, the bucket being a stable hash of device_aid.
+        Files are decoded in a process pool; each worker reads its file in chunks and streams every chunk
+        to one ParquetWriter per bucket, so memory stays bounded by a chunk per worker.
+        :param raw_folder: string, folder of the raw files, organised as month/day/*.gz
+        :param out_folder: string, root folder of the Parquet dataset
+        :param columns: list of strings, columns to keep from the raw files
+        :param num_buckets: int, number of device_aid buckets
+        :param chunk_size: int, number of rows read at a time
+        :param devices: set of device_aid to keep, all devices if None
+        :param num_cpus: int, number of processes, all CPUs if None
+        :return: None
+        """
+        self.raw_folder = raw_folder
+        self.out_folder = out_folder
+        self.columns = columns if columns is not None else ['timestamp', 'device_aid', 'latitude', 'longitude',
+                                                            'location_method']
+        self.num_buckets = num_buckets
+        self.chunk_size = chunk_size
+        self.devices = devices
+        self.num_cpus = num_cpus if num_cpus is not None else os.cpu_count()
+        self.schema = pa.schema([(c, RAW_FIELDS.get(c, pa.string())) for c in self.columns + ['utm_x', 'utm_y']])
+
+    def out_file(self, bucket, month, day, file):
+        """
+        :return: string, Parquet file of a raw file's rows of a bucket
+        """
+        return os.path.join(self.out_folder, f'bucket={bucket:02d}', f'month={month}', f'day={day}',
+                            file.split('.')[0] + '.parquet')
+
+    def ingest_file(self, month, day, file):
+        """
+        Read one raw file chunk by chunk, add UTM coordinates, and write each chunk's rows to their bucket.
+        Files are written under a temporary name and renamed when complete.
+        :param month: string, e.g., '06'
+        :param day: string, e.g., '01'
+        :param file: string, name of the raw file
+        :return: int, number of rows written
+        """
+        path = os.path.join(self.raw_folder, month, day, file)
+        dtypes = {c: str for c in self.columns if pa.types.is_string(RAW_FIELDS.get(c, pa.string()))}
+        writers = {}
+        num_rows = 0
+        try:
+            for chunk in pd.read_csv(path, sep='\t', compression='gzip', usecols=self.columns, dtype=dtypes,
+                                     chunksize=self.chunk_size):
+                if self.devices is not None:
+                    chunk = chunk.loc[chunk['device_aid'].isin(self.devices), :]
+                if len(chunk) == 0:
+                    continue
+                utm_x, utm_y = latlon_to_utm(chunk['latitude'].values, chunk['longitude'].values)
+                chunk = chunk[self.columns].assign(utm_x=utm_x, utm_y=utm_y)
+                bucket = uid_partition(chunk['device_aid'].values, num_partitions=self.num_buckets)
+                order = np.argsort(bucket, kind='stable')
+                bounds = np.flatnonzero(np.r_[True, bucket[order][1:] != bucket[order][:-1], True])
+                for s, e in zip(bounds[:-1], bounds[1:]):
+                    b = bucket[order[s]]
+                    if b not in writers:
+                        target = self.out_file(b, month, day, file)
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        writers[b] = pq.ParquetWriter(target + '.tmp', self.schema)
+                    writers[b].write_table(pa.Table.from_pandas(chunk.iloc[order[s:e]], schema=self.schema,
+                                                                preserve_index=False))
+                num_rows += len(chunk)
+        finally:
+            for w in writers.values():
+                w.close()
+        for b in writers:
+            target = self.out_file(b, month, day, file)
+            os.replace(target + '.tmp', target)
+        return num_rows
+
+    def ingest_day(self, month, day):
+        """
+        Convert all the raw files of a day, one file per task in the process pool.
+        :param month: string, e.g., '06'
+        :param day: string, e.g., '01'
+        :return: int, number of rows written
+        """
+        start = time.time()
+        tasks = [(month, day, f) for f in sorted(os.listdir(os.path.join(self.raw_folder, month, day)))]
+        if (self.num_cpus == 1) or (len(tasks) < 2):
+            rows = [self.ingest_file(*t) for t in tqdm(tasks, desc=f'Converting {month}-{day}')]
+        else:
+            with multiprocessing.Pool(min(self.num_cpus, len(tasks)), initializer=_init_worker,
+                                      initargs=(self,)) as pool:
+                rows = list(tqdm(pool.imap_unordered(_ingest_task, tasks), total=len(tasks),
+                                 desc=f'Converting {month}-{day}'))
+        print(f'{sum(rows)} rows of {month}-{day} converted in {(time.time() - start) / 60:.1f} minutes.')
+        return sum(rows)
+
+    def bucket_folder(self, bucket):
+        """
+        :param bucket: int, device_aid bucket
+        :return: string, folder of all the months and days of a bucket, readable as one dataset
+        """
+        return os.path.join(self.out_folder, f'bucket={bucket:02d}')
@@ -0,0 +1,86 @@
+import os
+import ast
+import random
+import numpy as np
+import pandas as pd
+
+
+def sim_expand(x, n=100):
+    """
+    Expand a stringified Counter of simulated destinations (legacy hex_s/hex_sd format) to a shuffled list.
+    :param x: string, e.g., "{'8a1f...': 3, ...}" or a single label
+    :param n: int, number of simulations for a single label
+    :return: list of labels
+    """
+    sim_list = []
+    if ':' in x:
+        sim_dict = ast.literal_eval(x)
+        for k, v in sim_dict.items():
+            sim_list += [k] * v
+        random.Random(4).shuffle(sim_list)
+    else:
+        sim_list += [x] * n
+    return sim_list
+
+
+class SimMatrix:
+    def __init__(self, path=None):
+        """
+        Simulated destinations of stays as an int32 matrix (stay_id, sim - 1) -> label code, -1 for none.
+        The matrix is stored column-major in {path}.npy and the labels in {path}_labels.npy,
+        so that one simulation is a contiguous memory-mapped slice [:, sim - 1].
+        :param path: string, path of the matrix without extension
+        :return: None
+        """
+        self.path = path
+        self.codes = np.load(path + '.npy', mmap_mode='r')
+        self.labels = np.load(path + '_labels.npy').astype(object)
+        print(f"Simulated destinations: {self.codes.shape[0]} stays x {self.codes.shape[1]} simulations.")
+
+    @staticmethod
+    def save(path, codes, labels):
+        """
+        :param path: string, path of the matrix without extension
+        :param codes: int matrix (stays x simulations) of label codes, -1 for none, row = stay_id
+        :param labels: array of labels
+        :return: None
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path + '.npy', np.asfortranarray(codes, dtype=np.int32))
+        np.save(path + '_labels.npy', np.asarray(labels).astype(str))
+
+    @staticmethod
+    def from_strings(values, n=100):
+        """
+        Convert legacy stringified Counters to a code matrix, keeping the order of sim_expand.
+        :param values: array of strings, '' or None for stays without simulation
+        :param n: int, number of simulations
+        :return: int32 matrix (stays x n) and array of labels
+        """
+        rows = [sim_expand(x, n=n)[:n] if isinstance(x, str) and (x != '') else [] for x in values]
+        lens = np.array([len(r) for r in rows], dtype=np.int64)
+        flat_codes, labels = pd.factorize(pd.Series([k for r in rows for k in r], dtype=object), sort=True)
+        codes = np.full((len(rows), n), -1, dtype=np.int32)
+        cols = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+        codes[np.repeat(np.arange(len(rows)), lens), cols] = flat_codes
+        return codes, np.asarray(labels, dtype=object)
+
+    def has_sim(self, stay_id):
+        """
+        :param stay_id: array of stay ids
+        :return: boolean array, true for stays with simulated destinations
+        """
+        return self.codes[:, 0][stay_id] >= 0
+
+    def column(self, stay_id, sim, fill=None):
+        """
+        Simulated destination of stays in one simulation.
+        :param stay_id: array of stay ids
+        :param sim: int, simulation number starting from 1
+        :param fill: array of labels to use where the stay has no simulated destination, e.g., the observed hex
+        :return: array of labels
+        """
+        c = np.asarray(self.codes[:, sim - 1])[stay_id]
+        out = self.labels[np.maximum(c, 0)]
+        out[c < 0] = None if fill is None else np.asarray(fill, dtype=object)[c < 0]
+        return out
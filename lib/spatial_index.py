@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import h3
+import shapely
+from shapely.strtree import STRtree
+
+
+def latlng2cell(lat, lng, reso):
+    """
+    H3 cell ids of coordinates at the given resolutions, each unique (lat, lng, reso) computed once.
+    Works with both the h3-py v3 (geo_to_h3) and v4 (latlng_to_cell) APIs.
+    :param lat: array of latitudes
+    :param lng: array of longitudes
+    :param reso: array of H3 resolutions
+    :return: array of cell ids (string)
+    """
+    to_cell = h3.latlng_to_cell if hasattr(h3, 'latlng_to_cell') else h3.geo_to_h3
+    keys = pd.MultiIndex.from_arrays([np.asarray(lat), np.asarray(lng), np.asarray(reso)])
+    codes, uniques = keys.factorize()
+    cells = np.array([to_cell(y, x, int(r)) for y, x, r in uniques], dtype=object)
+    return cells[codes]
+
+
+def cell_resolution(cells):
+    """
+    :param cells: array of H3 cell ids (string)
+    :return: array of resolutions
+    """
+    get_reso = h3.get_resolution if hasattr(h3, 'get_resolution') else h3.h3_get_resolution
+    return np.array([get_reso(c) for c in cells], dtype=np.int8)
+
+
+class SpatialUnitIndex:
+    def __init__(self, zones=None, hex_col='hex_id', deso_col='deso'):
+        """
+        Index of the mixed spatial units (hexagons within larger DeSO zones, DeSO zones otherwise).
+        The hexagons are put into one STRtree so that all stays are assigned with a single bulk query.
+        :param zones: geodataframe, spatial_units with deso, hex_id, and geom (hex_id == '0' for DeSO-only zones)
+        :param hex_col: string, column of hexagon id in zones
+        :param deso_col: string, column of DeSO code in zones
+        :return: None
+        """
+        if (zones.crs is not None) and (zones.crs.to_epsg() != 4326):
+            zones = zones.to_crs(4326)
+        is_hex = (zones[hex_col] != '0').values
+        self.deso_only = pd.Index(zones.loc[~is_hex, deso_col].unique())
+        self.hex_deso = pd.Index(zones.loc[is_hex, deso_col].unique())
+        self.hex_ids = zones.loc[is_hex, hex_col].values
+        self.hex_desos = zones.loc[is_hex, deso_col].values
+        self.tree = STRtree(np.array(list(zones.geometry.values[is_hex])))
+        # H3 resolution of each DeSO zone with hexagons (reso_assign by area in 31-h3-spatial-units.py)
+        first = pd.Series(self.hex_ids).groupby(self.hex_desos, sort=False).first()
+        self.deso_reso = pd.Series(cell_resolution(first.values), index=first.index)
+        self.hex_units = pd.MultiIndex.from_arrays([self.hex_desos, self.hex_ids])
+        print(f"Spatial units indexed: {len(self.hex_ids)} hexagons in {len(self.hex_deso)} DeSO zones, "
+              f"{len(self.deso_only)} DeSO zones without hexagons.")
+
+    @staticmethod
+    def mixed_labels(zones, hex_col='hex_id', deso_col='deso'):
+        """
+        Mixed label of each spatial unit: the hexagon id, or the DeSO code where hex_id == '0'.
+        :param zones: dataframe, spatial_units
+        :return: array of labels
+        """
+        return np.where(zones[hex_col].values != '0', zones[hex_col].values, zones[deso_col].values)
+
+    def match(self, lat, lng, deso):
+        """
+        Find the hexagons of the stays' DeSO zones that contain the stays.
+        Unique (lat, lng, deso) combinations are queried once and the matches broadcast back.
+        As an inner spatial join, stays outside any hexagon are left out and stays on a shared edge are repeated.
+        :param lat: array of latitudes
+        :param lng: array of longitudes
+        :param deso: array of DeSO codes of the stays
+        :return: positions of the matched stays and their hexagon ids
+        """
+        keys = pd.MultiIndex.from_arrays([np.asarray(lat), np.asarray(lng), np.asarray(deso)])
+        codes, uniques = keys.factorize()
+        u_lat, u_lng, u_deso = (uniques.get_level_values(i).values for i in range(3))
+        pi, zi = self.tree.query(shapely.points(u_lng, u_lat), predicate='intersects')
+        # Only the hexagons of the stay's own DeSO zone count, as in a join by zone
+        keep = self.hex_desos[zi] == u_deso[pi]
+        pi, zi = pi[keep], zi[keep]
+        order = np.argsort(pi, kind='stable')
+        pi, zi = pi[order], zi[order]
+
+        # Broadcast matches of the unique points back to the stays
+        counts = np.bincount(pi, minlength=len(uniques))
+        first = np.cumsum(counts) - counts
+        n = counts[codes]
+        rows = np.repeat(np.arange(len(codes)), n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        return rows, self.hex_ids[zi[first[codes[rows]] + k]]
+
+    def match_h3(self, lat, lng, deso):
+        """
+        Compute the hexagon of each stay directly as the H3 cell at its DeSO zone's resolution,
+        without point-in-polygon tests. Cells not kept in spatial_units for that zone
+        (e.g., clipped away when the hexagons were created) fall back to the DeSO code.
+        :param lat: array of latitudes
+        :param lng: array of longitudes
+        :param deso: array of DeSO codes of the stays, all in zones with hexagons
+        :return: array of hexagon ids (or DeSO codes), one per stay
+        """
+        deso = np.asarray(deso)
+        reso = self.deso_reso.reindex(deso).values
+        cells = latlng2cell(lat, lng, reso)
+        known = self.hex_units.get_indexer(pd.MultiIndex.from_arrays([deso, cells])) >= 0
+        return np.where(known, cells, deso)
+
+    def assign(self, data, x_field='lng', y_field='lat', deso_field='deso', hex_field='hex', fallback=True,
+               method='strtree'):
+        """
+        Add the mixed hexagon label to stays, replacing one spatial join per DeSO zone.
+        :param data: dataframe, stays with coordinates and DeSO code
+        :param x_field: string, col name of longitude
+        :param y_field: string, col name of latitude
+        :param deso_field: string, col name of DeSO code
+        :param hex_field: string, col name of the output label
+        :param fallback: boolean, if true, stays in DeSO zones without hexagons are kept with hex = DeSO code
+        :param method: string, 'strtree' for point-in-hexagon matching or 'h3' for direct H3 cell computation
+        :return: a dataframe of the stays with hex_field, stays in unknown zones dropped
+        """
+        in_hex = data[deso_field].isin(self.hex_deso).values
+        geo_hex = data.loc[in_hex, :]
+        if method == 'h3':
+            geo_hex = geo_hex.copy()
+            geo_hex.loc[:, hex_field] = self.match_h3(geo_hex[y_field].values, geo_hex[x_field].values,
+                                                      geo_hex[deso_field].values)
+        else:
+            rows, labels = self.match(geo_hex[y_field].values, geo_hex[x_field].values, geo_hex[deso_field].values)
+            geo_hex = geo_hex.iloc[rows].copy()
+            geo_hex.loc[:, hex_field] = labels
+        if not fallback:
+            return geo_hex
+        geo_deso = data.loc[data[deso_field].isin(self.deso_only).values, :].copy()
+        geo_deso.loc[:, hex_field] = geo_deso[deso_field]
+        return pd.concat([geo_hex, geo_deso])
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import glob
+import hashlib
+from pathlib import Path
+import sqlalchemy
+
+
+ROOT_dir = Path(__file__).parent.parent
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+import preprocess as preprocess
+from stage_catalog import StageCatalog
+
+
+def table_fingerprint(engine, table):
+    """
+    Fingerprint of a database table from its data: its storage file (changed by TRUNCATE, VACUUM FULL,
+    or re-creation), its row count, and the newest transaction that wrote a live row.
+    Activity counters such as n_tup_ins are left out, as they lag behind commits and are reset by a crash
+    or pg_stat_reset() without any data change.
+    :param engine: sqlalchemy engine
+    :param table: string, table name, schema-qualified if not in public
+    :return: string, fingerprint ('missing' if the table does not exist)
+    """
+    with engine.connect() as conn:
+        node = conn.execute(sqlalchemy.text("""SELECT relfilenode FROM pg_class WHERE oid = to_regclass(:t);"""),
+                            {'t': table}).scalar()
+        if node is None:
+            return 'missing'
+        row = conn.execute(sqlalchemy.text(f"""SELECT count(*), max(xmin::text::bigint) FROM {table};""")).fetchone()
+    return '|'.join(str(v) for v in (node,) + tuple(row))
+
+
+def file_fingerprint(path):
+    """
+    :param path: string, file or directory
+    :return: string, md5 of the file content; for a directory, of the relative path, size,
+    and modification time of its files (e.g., a stage dataset or a simulation matrix)
+    """
+    h = hashlib.md5()
+    if os.path.isdir(path):
+        for f in sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True)):
+            if os.path.isfile(f):
+                st = os.stat(f)
+                h.update(f'{os.path.relpath(f, path)}|{st.st_size}|{st.st_mtime_ns};'.encode())
+    elif os.path.isfile(path):
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                h.update(block)
+    else:
+        return 'missing'
+    return h.hexdigest()
+
+
+class StageCache:
+    def __init__(self, stage, tables=(), files=(), stages=(), params=None, engine=None,
+                 root=os.path.join(ROOT_dir, 'dbs', 'stage_cache')):
+        """
+        Record of a pipeline stage's progress, keyed by a fingerprint of its inputs and parameters.
+        A stage whose inputs and parameters are unchanged is skipped; a stage computed in parts
+        (user groups, simulations) resumes from the parts not yet marked done.
+        When the fingerprint changes, the progress is discarded and the caller rewrites the outputs.
+        :param stage: string, name of the stage, e.g., the output table
+        :param tables: list of strings, input database tables
+        :param files: list of strings, input files or directories
+        :param stages: list of strings, input stages of the StageCatalog, from the store if written there,
+        from their database tables otherwise
+        :param params: dict, parameters of the stage, e.g., {'weekday': 1, 'holiday': 0, 'sim': 50}
+        :param engine: sqlalchemy engine, the shared engine of preprocess.get_engine if None
+        :param root: string, directory of the stage manifests
+        :return: None
+        """
+        self.stage = stage
+        self.engine = preprocess.get_engine() if engine is None else engine
+        self.manifest = os.path.join(root, f'{stage}.json')
+        catalog = StageCatalog()
+        inputs = {f'table:{t}': table_fingerprint(self.engine, t) for t in tables}
+        inputs.update({f'file:{f}': file_fingerprint(f) for f in files})
+        for s in stages:
+            if catalog.exists(s):
+                inputs[f'stage:{s}'] = file_fingerprint(catalog.path(s))
+            else:
+                inputs[f'stage:{s}'] = table_fingerprint(self.engine, catalog.stages[s]['table'])
+        content = json.dumps({'inputs': inputs, 'params': params or {}}, sort_keys=True, default=str)
+        self.key = hashlib.md5(content.encode()).hexdigest()
+        stored = {}
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                stored = json.load(f)
+        self.changed = stored.get('key') != self.key
+        self.done = set() if self.changed else set(stored.get('done', []))
+        state = 'changed, recomputing' if self.changed else f'unchanged, {len(self.done)} parts done'
+        print(f'Stage {stage}: inputs {state}.')
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest), exist_ok=True)
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump({'stage': self.stage, 'key': self.key, 'done': sorted(self.done)}, f, indent=1)
+        os.replace(self.manifest + '.tmp', self.manifest)
+
+    def is_done(self, part='all'):
+        """
+        :param part: part of the stage, e.g., a simulation id, 'all' for the whole stage
+        :return: boolean, true if the part was completed with the current inputs
+        """
+        return str(part) in self.done
+
+    def pending(self, parts):
+        """
+        :param parts: list of parts of the stage
+        :return: list of the parts not yet completed with the current inputs
+        """
+        return [p for p in parts if not self.is_done(p)]
+
+    def mark(self, part='all'):
+        """
+        Record a part as completed, once its outputs are written.
+        :param part: part of the stage, 'all' for the whole stage
+        :return: None
+        """
+        self.done.add(str(part))
+        self.save()
+
+    def clear_table(self, table, where=None):
+        """
+        Delete the rows of an output table written by an earlier or interrupted run, so that appending is idempotent.
+        :param table: string, schema-qualified output table
+        :param where: dict, column -> value of the rows of one part, e.g., {'sim': 3}; all rows if None
+        :return: None
+        """
+        conds = ' AND '.join(f'"{k}" = :{k}' for k in (where or {}))
+        with self.engine.begin() as conn:
+            if conn.execute(sqlalchemy.text("""SELECT to_regclass(:t) IS NOT NULL;"""), {'t': table}).scalar():
+                conn.execute(sqlalchemy.text(f"""DELETE FROM {table}""" + (f""" WHERE {conds};""" if conds else ';')),
+                             dict(where or {}))
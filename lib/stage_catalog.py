@@ -0,0 +1,197 @@
+import os
+import sys
+import glob
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+
+
+ROOT_dir = Path(__file__).parent.parent
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+import preprocess as preprocess
+from bulk_writer import copy2db
+from stay_loader import StayLoader
+
+
+# Intermediate tables of the pipeline: Postgres table and the columns their Parquet datasets are partitioned by
+STAGES = {
+    'mobi_seg_deso_raw': {'table': 'segregation.mobi_seg_deso_raw', 'partition_cols': ['weekday', 'holiday'],
+                          'compact': True},
+    'mobi_seg_hex_raw': {'table': 'segregation.mobi_seg_hex_raw', 'partition_cols': ['weekday', 'holiday'],
+                         'compact': True},
+    'mobi_seg_hex': {'table': 'segregation.mobi_seg_hex', 'partition_cols': ['weekday', 'holiday'],
+                     'compact': False},
+    'mobi_seg_hex_individual': {'table': 'segregation.mobi_seg_hex_individual',
+                                'partition_cols': ['weekday', 'holiday'], 'compact': False},
+}
+
+
+def filter_expression(filters):
+    """
+    :param filters: dict, column -> value or list of values, e.g., {'weekday': 1, 'holiday': 0}
+    :return: pyarrow.dataset expression, None if no filters
+    """
+    import pyarrow.dataset as ds
+    expr = None
+    for k, v in (filters or {}).items():
+        e = ds.field(k).isin(list(v)) if isinstance(v, (list, tuple, set, np.ndarray)) else (ds.field(k) == v)
+        expr = e if expr is None else (expr & e)
+    return expr
+
+
+def filter_sql(filters):
+    """
+    :param filters: dict, column -> value or list of values
+    :return: string, the same condition in SQL, None if no filters
+    """
+    conds = []
+    for k, v in (filters or {}).items():
+        if isinstance(v, (list, tuple, set, np.ndarray)):
+            conds.append(f"""{k} IN ({', '.join(repr(x.item() if hasattr(x, 'item') else x) for x in v)})""")
+        else:
+            conds.append(f"""{k}={v!r}""")
+    return ' AND '.join(conds) if conds else None
+
+
+class StageCatalog:
+    def __init__(self, root=os.path.join(ROOT_dir, 'dbs', 'stages'), stages=None):
+        """
+        Local columnar store of the pipeline stages: one Parquet dataset per stage, hive-partitioned
+        (e.g., weekday=1/holiday=0), so that a stage reads only the columns and partitions it needs
+        from memory-mapped files instead of a full read_sql round trip. Writing to Postgres is optional.
+        :param root: string, directory of the stage datasets
+        :param stages: dict, stage -> {'table', 'partition_cols', 'compact'}, STAGES by default
+        :return: None
+        """
+        self.root = root
+        self.stages = STAGES if stages is None else stages
+
+    def path(self, stage):
+        return os.path.join(self.root, stage)
+
+    def exists(self, stage):
+        """
+        :param stage: string, stage name
+        :return: boolean, true if the stage has data in the store
+        """
+        return len(self.files(stage)) > 0
+
+    def remove(self, stage):
+        """
+        Delete all the data of a stage from the store.
+        :param stage: string, stage name
+        :return: None
+        """
+        shutil.rmtree(self.path(stage), ignore_errors=True)
+
+    def files(self, stage, part=None):
+        """
+        :param stage: string, stage name
+        :param part: string, only the files written under this part name, all if None
+        :return: list of Parquet files of the stage
+        """
+        name = '*' if part is None else f'part-{part}-*'
+        return sorted(glob.glob(os.path.join(self.path(stage), '**', f'{name}.parquet'), recursive=True))
+
+    def partitioning(self, stage, schema):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        cols = self.stages[stage]['partition_cols']
+        fields = [schema.field(c) if c in schema.names else pa.field(c, pa.int8()) for c in cols]
+        return ds.partitioning(pa.schema(fields), flavor='hive')
+
+    def write(self, df, stage, part='all'):
+        """
+        Write a dataframe to the stage, replacing what was written before under the same part name,
+        so that a stage written group by group can be rerun without duplicating rows.
+        The files are written to a temporary folder and moved into the partitions when complete.
+        Use export to copy the stage to Postgres once all its parts are written.
+        :param df: dataframe, with the partition columns of the stage
+        :param stage: string, stage name
+        :param part: string, name of this piece of the stage, e.g., a user group; 'all' for a stage written at once
+        :return: None
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        start = time.time()
+        part = str(part)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        tmp = os.path.join(self.path(stage), f'.tmp-{part}')
+        shutil.rmtree(tmp, ignore_errors=True)
+        ds.write_dataset(table, tmp, format='parquet', partitioning=self.partitioning(stage, table.schema),
+                         basename_template=f'part-{part}-{{i}}.parquet', existing_data_behavior='overwrite_or_ignore')
+        for f in self.files(stage, part=part):
+            if not f.startswith(tmp + os.sep):
+                os.remove(f)
+        for f in glob.glob(os.path.join(tmp, '**', '*.parquet'), recursive=True):
+            target = os.path.join(self.path(stage), os.path.relpath(f, tmp))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(f, target)
+        shutil.rmtree(tmp, ignore_errors=True)
+        print(f'{len(df)} rows written to stage {stage} (part {part}) in {time.time() - start:.1f} seconds.')
+
+    def dataset(self, stage):
+        """
+        :param stage: string, stage name
+        :return: pyarrow dataset of the stage, read through memory-mapped files
+        """
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+        files = self.files(stage)
+        schema = ds.dataset(files[0], format='parquet').schema
+        return ds.dataset(self.path(stage), format='parquet', filesystem=fs.LocalFileSystem(use_mmap=True),
+                          partitioning=self.partitioning(stage, schema), exclude_invalid_files=True)
+
+    def read(self, stage, columns=None, filters=None, limit=None):
+        """
+        Read a stage from the store; only the partitions matching the filters and the requested columns are read.
+        :param stage: string, stage name
+        :param columns: list of strings, columns to load, all if None
+        :param filters: dict, column -> value or list of values, e.g., {'weekday': 1, 'holiday': 0}
+        :param limit: int, maximum number of rows
+        :return: a dataframe
+        """
+        start = time.time()
+        dataset = self.dataset(stage)
+        expr = filter_expression(filters)
+        if limit is not None:
+            table = dataset.head(int(limit), columns=columns, filter=expr)
+        else:
+            table = dataset.to_table(columns=columns, filter=expr)
+        df = table.to_pandas()
+        print(f'{len(df)} rows loaded from stage {stage} in {time.time() - start:.1f} seconds.')
+        return df
+
+    def load(self, stage, columns, filters=None, limit=None, engine=None):
+        """
+        Read a stage from the store if it has been written there, otherwise from its Postgres table.
+        :param stage: string, stage name
+        :param columns: list of strings, columns to load
+        :param filters: dict, column -> value or list of values
+        :param limit: int, maximum number of rows
+        :param engine: sqlalchemy engine for the Postgres fallback
+        :return: a dataframe
+        """
+        if self.exists(stage):
+            return self.read(stage, columns=columns, filters=filters, limit=limit)
+        print(f'Stage {stage} not in the store, loading it from the database.')
+        loader = StayLoader(table=self.stages[stage]['table'], compact=self.stages[stage]['compact'], engine=engine)
+        return loader.read(columns, where=filter_sql(filters), limit=limit)
+
+    def export(self, stage, engine=None, if_exists='replace'):
+        """
+        Copy a stage from the store to its Postgres table, one partition at a time.
+        :param stage: string, stage name
+        :param engine: sqlalchemy engine, the shared engine of preprocess.get_engine if None
+        :param if_exists: string, 'replace' or 'append' for the first partition, later ones are appended
+        :return: None
+        """
+        engine = preprocess.get_engine() if engine is None else engine
+        schema, table_name = self.stages[stage]['table'].split('.')
+        dataset = self.dataset(stage)
+        for fragment in dataset.get_fragments():
+            df = fragment.to_table(schema=dataset.schema).to_pandas()
+            copy2db(df, table_name, engine, schema=schema, if_exists=if_exists)
+            if_exists = 'append'
@@ -0,0 +1,193 @@
+import os
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+ROOT_dir = Path(__file__).parent.parent
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+import preprocess as preprocess
+
+
+# Compact dtypes of the stay tables, e.g., segregation.mobi_seg_deso_raw
+STAY_DTYPES = {'uid': object, 'lat': np.float32, 'lng': np.float32, 'holiday': np.int8, 'weekday': np.int8,
+               'wt_total': np.float32, 'deso': 'category', 'hex': 'category', 'zone': 'category',
+               's1': np.int8, 'e1': np.int8, 's2': np.int8, 'e2': np.int8}
+
+
+def uid_partition(uid, num_partitions=16):
+    """
+    Partition of each user by a hash of the uid that is stable across chunks and runs.
+    :param uid: array of user ids
+    :param num_partitions: int, number of partitions
+    :return: int array of partitions
+    """
+    return (pd.util.hash_array(np.asarray(uid, dtype=object)) % np.uint64(num_partitions)).astype(np.int64)
+
+
+class StayLoader:
+    def __init__(self, table='segregation.mobi_seg_deso_raw', compact=True, dtypes=None, chunk_size=1000000,
+                 engine=None):
+        """
+        Stream a stay table from the database in chunks through a server-side cursor,
+        so that the table never has to be held in memory at once in its text-heavy default dtypes.
+        :param table: string, schema-qualified table of stays
+        :param compact: boolean, if true, the chunks take STAY_DTYPES (float32 coordinates are accurate to
+        about half a meter); if false, only the time span columns are downcast, e.g., where stays are matched
+        to home coordinates or zones are grouped as plain strings
+        :param dtypes: dict, column -> dtype of the loaded chunks, overrides compact
+        :param chunk_size: int, number of rows fetched per chunk
+        :param engine: sqlalchemy engine, the shared engine of preprocess.get_engine if not given
+        :return: None
+        """
+        self.table = table
+        if dtypes is None:
+            dtypes = STAY_DTYPES if compact else {c: np.int8 for c in preprocess.time_span_cols}
+        self.dtypes = dtypes
+        self.chunk_size = chunk_size
+        self.engine = preprocess.get_engine() if engine is None else engine
+
+    def query(self, columns, where=None, limit=None):
+        """
+        :param columns: list of strings, columns to load
+        :param where: string, SQL condition, e.g., 'weekday=1 AND holiday=0'
+        :param limit: int, maximum number of rows
+        :return: string, SQL query
+        """
+        sql = f"""SELECT {', '.join(columns)} FROM {self.table}"""
+        if where is not None:
+            sql += f""" WHERE {where}"""
+        if limit is not None:
+            sql += f""" LIMIT {int(limit)}"""
+        return sql + ';'
+
+    def chunks(self, columns, where=None, limit=None):
+        """
+        :param columns: list of strings, columns to load
+        :param where: string, SQL condition
+        :param limit: int, maximum number of rows
+        :return: generator of dataframes of at most chunk_size rows, with dtypes applied
+        """
+        conn = self.engine.raw_connection()
+        try:
+            # A named cursor keeps the result on the server and fetches it chunk by chunk
+            cur = conn.cursor(name='stay_loader')
+            cur.itersize = self.chunk_size
+            cur.execute(self.query(columns, where=where, limit=limit))
+            while True:
+                rows = cur.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                df = pd.DataFrame.from_records(rows, columns=columns)
+                yield df.astype({k: v for k, v in self.dtypes.items() if k in df.columns})
+            cur.close()
+        finally:
+            conn.close()
+
+    def read(self, columns, where=None, limit=None):
+        """
+        Load the selected rows into one dataframe, chunk by chunk, in the compact dtypes.
+        :param columns: list of strings, columns to load
+        :param where: string, SQL condition
+        :param limit: int, maximum number of rows
+        :return: a dataframe
+        """
+        dfs = list(self.chunks(columns, where=where, limit=limit))
+        if len(dfs) == 0:
+            return pd.DataFrame({c: pd.Series(dtype=self.dtypes.get(c, object)) for c in columns})
+        cats = [c for c in columns if isinstance(dfs[0][c].dtype, pd.CategoricalDtype)]
+        # Chunks have their own categories, unify them before concatenating
+        for c in cats:
+            unified = union_categoricals([d[c] for d in dfs]).categories
+            for d in dfs:
+                d[c] = d[c].cat.set_categories(unified)
+        df = pd.concat(dfs, ignore_index=True)
+        print(f'{len(df)} rows loaded from {self.table} ({df.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB).')
+        return df
+
+    def arrow_schema(self, df):
+        """
+        Arrow schema of the batches: columns with a dtype take its type, categorical columns are dictionaries
+        with int32 indices, and the other columns the type inferred from the first chunk.
+        Columns without a dtype that are all NULL in the first chunk are taken as strings, e.g., hex.
+        :param df: dataframe, the first chunk
+        :return: pyarrow.Schema
+        """
+        import pyarrow as pa
+        fields = []
+        for f in pa.Schema.from_pandas(df, preserve_index=False):
+            dtype = self.dtypes.get(f.name)
+            if isinstance(df[f.name].dtype, pd.CategoricalDtype) or (dtype == 'category'):
+                value_type = f.type.value_type if pa.types.is_dictionary(f.type) else f.type
+                value_type = pa.string() if pa.types.is_null(value_type) else value_type
+                f = pa.field(f.name, pa.dictionary(pa.int32(), value_type))
+            elif dtype is not None and dtype is not object:
+                f = pa.field(f.name, pa.from_numpy_dtype(np.dtype(dtype)))
+            elif pa.types.is_null(f.type):
+                f = pa.field(f.name, pa.string())
+            fields.append(f)
+        return pa.schema(fields)
+
+    def batches(self, columns, where=None, limit=None, num_partitions=16):
+        """
+        Arrow record batches of the selected rows, each chunk split by uid hash partition,
+        so that all the stays of a user are in the same partition.
+        All batches share one schema, see arrow_schema.
+        :param columns: list of strings, columns to load, including uid
+        :param where: string, SQL condition
+        :param limit: int, maximum number of rows
+        :param num_partitions: int, number of uid partitions
+        :return: generator of (partition, pyarrow.RecordBatch)
+        """
+        import pyarrow as pa
+        schema = None
+        for df in self.chunks(columns, where=where, limit=limit):
+            if schema is None:
+                schema = self.arrow_schema(df)
+            part = uid_partition(df['uid'].values, num_partitions=num_partitions)
+            order = np.argsort(part, kind='stable')
+            bounds = np.flatnonzero(np.r_[True, part[order][1:] != part[order][:-1], True])
+            for s, e in zip(bounds[:-1], bounds[1:]):
+                yield part[order[s]], pa.RecordBatch.from_pandas(df.iloc[order[s:e]], schema=schema,
+                                                                 preserve_index=False)
+
+    def partition(self, path, columns, where=None, limit=None, num_partitions=16):
+        """
+        Spill the selected rows to disk as one Arrow IPC stream file per uid partition,
+        to process the table partition by partition with read_partition.
+        :param path: string, directory of the partition files
+        :param columns: list of strings, columns to load, including uid
+        :param where: string, SQL condition
+        :param limit: int, maximum number of rows
+        :param num_partitions: int, number of uid partitions
+        :return: list of partition files
+        """
+        import pyarrow as pa
+        os.makedirs(path, exist_ok=True)
+        files = [os.path.join(path, f'part_{p:03d}.arrow') for p in range(num_partitions)]
+        writers = {}
+        try:
+            for p, batch in self.batches(columns, where=where, limit=limit, num_partitions=num_partitions):
+                if p not in writers:
+                    writers[p] = pa.ipc.new_stream(files[p], batch.schema)
+                writers[p].write_batch(batch)
+        finally:
+            for w in writers.values():
+                w.close()
+        return [f for p, f in enumerate(files) if p in writers]
+
+    def read_partition(self, file, columns=None):
+        """
+        :param file: string, partition file written by partition
+        :param columns: list of strings, columns to keep, all if None
+        :return: a dataframe of the partition with dtypes applied
+        """
+        import pyarrow as pa
+        with pa.memory_map(file, 'r') as source:
+            df = pa.ipc.open_stream(source).read_pandas()
+        if columns is not None:
+            df = df[columns]
+        return df.astype({k: v for k, v in self.dtypes.items() if k in df.columns})
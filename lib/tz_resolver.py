@@ -0,0 +1,87 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from timezonefinder import TimezoneFinder
+
+
+ROOT_dir = Path(__file__).parent.parent
+
+# TimezoneFinder of this process, slow to initialise, so created once at the first lookup
+_finder = {}
+
+
+def shared_finder():
+    """
+    :return: the TimezoneFinder shared by all lookups of this process
+    """
+    if 'tf' not in _finder:
+        _finder['tf'] = TimezoneFinder()
+    return _finder['tf']
+
+
+class TimezoneResolver:
+    def __init__(self, grid=0.01, cache_file=None, cache_size=100000):
+        """
+        Time zone names of coordinates resolved per grid cell: coordinates are rounded to the grid,
+        and each cell is looked up once, at its centre, with the shared TimezoneFinder.
+        Resolved cells are kept in an LRU cache and in a file, so that later runs resolve from the file.
+        :param grid: float, cell size in degrees (0.01 is about 1 km; coarser grids may misplace points near borders)
+        :param cache_file: string, CSV of resolved cells, dbs/timezone_cells_<grid>.csv by default
+        :param cache_size: int, maximum number of cells in the LRU cache
+        :return: None
+        """
+        self.grid = grid
+        self.cache_file = cache_file if cache_file is not None else \
+            os.path.join(ROOT_dir, 'dbs', f'timezone_cells_{grid}.csv')
+        self.stored = {}
+        if os.path.exists(self.cache_file):
+            df = pd.read_csv(self.cache_file, dtype={'tzname': object}, keep_default_na=False)
+            tznames = df['tzname'].where(df['tzname'] != '', None)
+            self.stored = dict(zip(zip(df['lat_cell'].tolist(), df['lng_cell'].tolist()), tznames))
+        self.new = {}
+        self.cell_timezone = lru_cache(maxsize=cache_size)(self._cell_timezone)
+
+    def _cell_timezone(self, lat_cell, lng_cell):
+        """
+        :param lat_cell: int, latitude cell index
+        :param lng_cell: int, longitude cell index
+        :return: string, time zone name of the cell, None if unknown
+        """
+        key = (lat_cell, lng_cell)
+        if key in self.stored:
+            return self.stored[key]
+        try:
+            tzname = shared_finder().timezone_at(lng=lng_cell * self.grid, lat=lat_cell * self.grid)
+        except ValueError:
+            tzname = None
+        self.new[key] = tzname
+        return tzname
+
+    def resolve(self, lat, lng):
+        """
+        :param lat: array of latitudes
+        :param lng: array of longitudes
+        :return: object array of time zone names, None where unknown
+        """
+        cells = np.column_stack([np.round(np.asarray(lat, dtype=np.float64) / self.grid),
+                                 np.round(np.asarray(lng, dtype=np.float64) / self.grid)]).astype(np.int64)
+        uniq, inverse = np.unique(cells, axis=0, return_inverse=True)
+        names = np.array([self.cell_timezone(int(a), int(b)) for a, b in uniq], dtype=object)
+        print(f'{len(cells)} points in {len(uniq)} cells, {len(self.new)} cells looked up.')
+        self.save()
+        return names[inverse.ravel()]
+
+    def save(self):
+        """
+        Append the cells looked up since the last save to the cache file.
+        :return: None
+        """
+        if len(self.new) == 0:
+            return
+        df = pd.DataFrame([(a, b, t) for (a, b), t in self.new.items()], columns=['lat_cell', 'lng_cell', 'tzname'])
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        df.to_csv(self.cache_file, mode='a', index=False, header=not os.path.exists(self.cache_file))
+        self.stored.update(self.new)
+        self.new = {}
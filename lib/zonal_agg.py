@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+
+# Population shares of the ICE birth-background groups (born in Sweden, born outside Europe)
+SHARE_A = 0.8044332515556147
+SHARE_B = 0.11067529894925136
+
+
+def _length_classes(starts, lengths):
+    """
+    Segments grouped by length, each class gathered as a (segments x length) matrix of positions.
+    :param starts: array of segment starts in the sorted rows
+    :param lengths: array of segment lengths
+    :return: generator of (segment indices, position matrix)
+    """
+    for n in np.unique(lengths):
+        idx = np.flatnonzero(lengths == n)
+        yield idx, starts[idx, None] + np.arange(n)
+
+
+def segment_sums(values, starts, lengths, sequential=False):
+    """
+    Sum of each segment, bit for bit np.sum of the segment (pairwise summation, as in pandas' sum)
+    or, if sequential, the left-to-right Python built-in sum.
+    :param values: array of values, rows sorted by segment
+    :param starts: array of segment starts
+    :param lengths: array of segment lengths
+    :param sequential: boolean, if true, add the values left to right
+    :return: array of sums, one per segment
+    """
+    out = np.empty(len(starts))
+    for idx, pos in _length_classes(starts, lengths):
+        out[idx] = np.cumsum(values[pos], axis=1)[:, -1] if sequential else values[pos].sum(axis=1)
+    return out
+
+
+def _interp_half(xp, fp, x=0.5):
+    """
+    Row-wise np.interp(x, xp[i], fp[i]) with the same branches and arithmetic as numpy's implementation.
+    """
+    n = xp.shape[1]
+    rows = np.arange(len(xp))
+    j = np.clip((xp <= x).sum(axis=1) - 1, 0, n - 1)
+    j1 = np.minimum(j + 1, n - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (fp[rows, j1] - fp[rows, j]) / (xp[rows, j1] - xp[rows, j])
+        res = slope * (x - xp[rows, j]) + fp[rows, j]
+        alt = slope * (x - xp[rows, j1]) + fp[rows, j1]
+    res = np.where(np.isnan(res), alt, res)
+    res = np.where(np.isnan(res) & (fp[rows, j] == fp[rows, j1]), fp[rows, j], res)
+    res = np.where((j == n - 1) | (xp[rows, j] == x), fp[rows, j], res)
+    res = np.where(x < xp[:, 0], fp[:, 0], res)
+    return np.where(x > xp[:, -1], fp[:, -1], res)
+
+
+def segment_weighted_median(values, weights, starts, lengths):
+    """
+    Weighted median of each segment as computed by wquantiles.median: values sorted within the segment,
+    cumulative weights centred on each value, and interpolation at 0.5.
+    Segments of the same length are sorted together row-wise by np.argsort, which orders tied values
+    as the sort of each segment alone does.
+    :param values: array of values, rows sorted by segment
+    :param weights: array of weights, rows sorted by segment
+    :param starts: array of segment starts
+    :param lengths: array of segment lengths
+    :return: array of weighted medians, one per segment
+    """
+    out = np.empty(len(starts))
+    for idx, pos in _length_classes(starts, lengths):
+        v, w = values[pos], weights[pos]
+        o = np.argsort(v, axis=1)
+        v, w = np.take_along_axis(v, o, axis=1).astype(np.float64), np.take_along_axis(w, o, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pn = (np.cumsum(w, axis=1) - 0.5 * w) / w.sum(axis=1)[:, None]
+        out[idx] = _interp_half(pn, v)
+    return out
+
+
+def zonal_aggregate(data, keys=('weekday', 'holiday', 'hex'), cols=None, time_col='time_seq',
+                    weight_col='wt_total', uid_col='uid'):
+    """
+    Visiting strength, weighted medians of mobility and segregation measures, income evenness, and ICE
+    of each spatiotemporal unit, replacing groupby(keys).apply(unit_weighted_median) per time_seq.
+    Rows are sorted once by unit and units of the same size are processed together as matrices,
+    keeping the order of every sort and sum of the per-group version, so the output equals it bit for bit.
+    :param data: dataframe, exploded stays with keys, time_col, weight_col, uid_col, cols,
+    income_q1-4, birth_se, birth_other, and pop
+    :param keys: tuple of strings, columns of the unit, e.g., ('weekday', 'holiday', 'hex')
+    :param cols: list of strings, columns to take the weighted median of
+    :param time_col: string, column of time sequence
+    :param weight_col: string, column of weight
+    :param uid_col: string, column of user id
+    :return: a dataframe of keys, time_col, num_visits, num_visits_wt, num_unique_uid, cols,
+    evenness_income, and ice_birth, ordered by time_col and then keys
+    """
+    keys = list(keys)
+    codes = data.groupby([time_col] + keys, sort=True).ngroup().values
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) > 0 else np.empty(0, dtype=np.int64)
+    lengths = np.diff(np.r_[starts, len(codes)])
+    first = order[starts]
+    w = data[weight_col].values[order].astype(np.float64)
+
+    df = data[keys].iloc[first].reset_index(drop=True)
+    df.loc[:, time_col] = data[time_col].values[first].astype(np.float64)
+    # Visiting strength measure
+    df.loc[:, 'num_visits'] = lengths.astype(np.float64)
+    df.loc[:, 'num_visits_wt'] = segment_sums(np.where(np.isnan(w), 0, w), starts, lengths)
+    uid_codes = pd.factorize(data[uid_col].values[order])[0]
+    uo = np.lexsort((uid_codes, codes))
+    new_uid = np.r_[True, (uid_codes[uo][1:] != uid_codes[uo][:-1]) | (codes[uo][1:] != codes[uo][:-1])] \
+        & (uid_codes[uo] >= 0)
+    df.loc[:, 'num_unique_uid'] = np.bincount(codes[uo][new_uid], minlength=codes.max() + 1 if len(codes) else 0)[
+        codes[starts]].astype(np.float64)
+
+    # Mobility patterns and segregation measures
+    for v in cols:
+        df.loc[:, v] = segment_weighted_median(data[v].values[order], w, starts, lengths)
+
+    def wsum(col):
+        return segment_sums(data[col].values[order] * w, starts, lengths, sequential=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Modified aggregation of income unevenness
+        q = [wsum(f'income_q{i}') for i in (1, 2, 3, 4)]
+        sum_ = ((q[0] + q[1]) + q[2]) + q[3]
+        suma = sum([np.abs(qi / sum_ - 1 / 4) for qi in q])
+        df.loc[:, 'evenness_income'] = np.where(sum_ != 0, 4 / (2 * 4 - 2) * suma, np.nan)
+        # Modified ICE
+        ai, bi, popi = wsum('birth_se'), wsum('birth_other'), wsum('pop')
+        oi = popi - ai - bi
+        share_o = 1 - SHARE_A - SHARE_B
+        ice = (ai / SHARE_A - bi / SHARE_B) / (ai / SHARE_A + bi / SHARE_B + oi / share_o)
+        df.loc[:, 'ice_birth'] = np.where(((ai + bi) + popi) != 0, ice, np.nan)
+    return df
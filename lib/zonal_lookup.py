@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+
+class ZonalLookup:
+    def __init__(self, data=None, zone_col='hex', value_col='ice_birth',
+                 keys=('weekday', 'holiday', 'time_seq'), dtype=np.float64):
+        """
+        Dense lookup table of a zonal metric by (weekday, holiday, time_seq, zone).
+        Keys and zones are encoded as integer codes once, so exploded stays are
+        resolved with a single fancy-indexing gather instead of a .loc call per row.
+        :param data: dataframe, long-format zonal metrics, e.g., segregation.mobi_seg_hex
+        :param zone_col: string, column of zone id, e.g., 'hex' or 'osm_id'
+        :param value_col: string, column of the metric to look up, e.g., 'ice_birth'
+        :param keys: tuple of strings, temporal key columns; those absent in data are ignored
+        (e.g., when the zonal metrics are already filtered to weekday=1 AND holiday=0)
+        :param dtype: numpy dtype of the dense table
+        :return: None
+        """
+        self.zone_col = zone_col
+        self.value_col = value_col
+        self.keys = [k for k in keys if k in data.columns] + [zone_col]
+        self.levels = [pd.Index(np.sort(data[k].dropna().unique())) for k in self.keys]
+        codes = [lv.get_indexer(data[k].values) for lv, k in zip(self.levels, self.keys)]
+        valid = np.all([c >= 0 for c in codes], axis=0)
+        shape = tuple(len(lv) for lv in self.levels)
+        self.table = np.full(shape, np.nan, dtype=dtype)
+        self.table[tuple(c[valid] for c in codes)] = data[value_col].values[valid]
+        print(f"Lookup table of {value_col}: {' x '.join(str(s) for s in shape)} "
+              f"({self.table.nbytes / 1024 ** 2:.1f} MB).")
+
+    def codes(self, data, zone_col=None):
+        """
+        Encode the key columns of data as a flat position in the dense table.
+        :param data: dataframe, containing the key columns and the zone column
+        :param zone_col: string, zone column in data if named differently, e.g., 'hex_s'
+        :return: array of flat positions, -1 for keys not found in the table
+        """
+        cols = self.keys[:-1] + [zone_col if zone_col is not None else self.zone_col]
+        codes = [lv.get_indexer(pd.Index(data[c].values)) for lv, c in zip(self.levels, cols)]
+        miss = np.zeros(len(data), dtype=bool)
+        for c in codes:
+            miss |= c < 0
+        flat = np.ravel_multi_index(tuple(np.where(miss, 0, c) for c in codes), self.table.shape)
+        flat[miss] = -1
+        return flat
+
+    def lookup(self, data, zone_col=None):
+        """
+        Look up the zonal metric for each row of data.
+        :param data: dataframe, e.g., stays exploded on time_seq with weekday, holiday, and hex
+        :param zone_col: string, zone column in data if named differently, e.g., 'hex_s'
+        :return: array of metric values, NaN where the (keys, zone) combination is missing
+        """
+        flat = self.codes(data, zone_col=zone_col)
+        values = self.table.ravel()[np.where(flat < 0, 0, flat)]
+        values[flat < 0] = np.nan
+        return values
@@ -0,0 +1,143 @@
+import os
+import sys
+import glob
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.strtree import STRtree
+
+
+ROOT_dir = Path(__file__).parent.parent
+sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
+
+from poi_index import zones_hash
+
+
+def coord_key(lat, lng, precision=6):
+    """
+    Integer key of coordinates quantized to 10^-precision degrees (1e-6 degrees is about 0.1 m),
+    exact to compare and join on, unlike float columns.
+    :param lat: array of latitudes
+    :param lng: array of longitudes
+    :param precision: int, number of decimals kept, at most 6
+    :return: int64 array of keys
+    """
+    scale = 10 ** precision
+    lat_q = np.round(np.asarray(lat, dtype=np.float64) * scale).astype(np.int64) + 90 * scale
+    lng_q = np.round(np.asarray(lng, dtype=np.float64) * scale).astype(np.int64) + 180 * scale
+    return lat_q * (360 * scale + 1) + lng_q
+
+
+class ZoneAssignmentCache:
+    def __init__(self, zones=None, label_col='deso', precision=6,
+                 cache_dir=os.path.join(ROOT_dir, 'dbs', 'zone_cache'), max_parts=32):
+        """
+        Persistent coordinate -> zone table, so that coordinates assigned in earlier months and runs
+        are not tested against the zones again; only coordinates missing from the table are resolved.
+        The table is a folder of Parquet files keyed by the hash of the zones, so it is rebuilt when they change.
+        :param zones: geodataframe, zones with label_col and geometry
+        :param label_col: string, column of zone label
+        :param precision: int, decimals of the quantized coordinate keys
+        :param cache_dir: string, directory of the cached tables
+        :param max_parts: int, the delta files are merged into one when there are more
+        :return: None
+        """
+        if (zones.crs is not None) and (zones.crs.to_epsg() != 4326):
+            zones = zones.to_crs(4326)
+        self.labels = zones[label_col].values
+        self.geoms = np.array(list(zones.geometry.values))
+        self.tree = None
+        self.precision = precision
+        self.path = os.path.join(cache_dir, f'{label_col}_{zones_hash(zones, label_col)[:16]}')
+        self.max_parts = max_parts
+        self.table = self.load()
+        print(f"Zone cache: {len(self.table)} coordinates already assigned to {len(zones)} zones.")
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part_*.parquet')))
+
+    def load(self):
+        """
+        :return: series of zone labels (None outside all zones) indexed by coordinate key
+        """
+        files = self.parts()
+        if len(files) == 0:
+            return pd.Series(dtype=object, index=pd.Index([], dtype=np.int64))
+        df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+        table = pd.Series(df['label'].values, index=pd.Index(df['key'].values))
+        table = table[~table.index.duplicated(keep='first')]
+        if len(files) > self.max_parts:
+            self.write(table, name='part_00000.parquet')
+            for f in files:
+                if os.path.basename(f) != 'part_00000.parquet':
+                    os.remove(f)
+        return table
+
+    def write(self, table, name=None):
+        """
+        Write assignments to a new Parquet file of the table, under a temporary name renamed when complete.
+        :param table: series of labels indexed by coordinate key
+        :param name: string, file name, the next part number if None
+        :return: None
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if name is None:
+            files = self.parts()
+            last = int(os.path.basename(files[-1])[5:10]) if len(files) > 0 else -1
+            name = f'part_{last + 1:05d}.parquet'
+        target = os.path.join(self.path, name)
+        df = pd.DataFrame({'key': table.index.values.astype(np.int64), 'label': table.values})
+        df.to_parquet(target + '.tmp', index=False)
+        os.replace(target + '.tmp', target)
+
+    def locate(self, lat, lng):
+        """
+        Zone of each point with one bulk STRtree query: a zone containing the point,
+        or for points on zone edges, the first zone touching it.
+        :param lat: array of latitudes
+        :param lng: array of longitudes
+        :return: object array of zone labels, None outside all zones
+        """
+        if self.tree is None:
+            self.tree = STRtree(self.geoms)
+        points = shapely.points(np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        out = np.full(len(points), None, dtype=object)
+        pi, zi = self.tree.query(points, predicate='within')
+        # Points can only be within one zone of a partition; keep the first zone in case of overlaps
+        order = np.lexsort((zi, pi))
+        pi, zi = pi[order], zi[order]
+        first = np.r_[True, pi[1:] != pi[:-1]]
+        out[pi[first]] = self.labels[zi[first]]
+        edge = np.flatnonzero(pd.isna(out))
+        if len(edge) > 0:
+            pi, zi = self.tree.query(points[edge], predicate='intersects')
+            order = np.lexsort((zi, pi))
+            pi, zi = pi[order], zi[order]
+            first = np.r_[True, pi[1:] != pi[:-1]]
+            out[edge[pi[first]]] = self.labels[zi[first]]
+        return out
+
+    def resolve(self, lat, lng):
+        """
+        Zone of each point, from the table where the coordinates were assigned before,
+        otherwise located and added to the table.
+        :param lat: array of latitudes
+        :param lng: array of longitudes
+        :return: object array of zone labels, NaN outside all zones
+        """
+        keys = coord_key(lat, lng, precision=self.precision)
+        uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        pos = self.table.index.get_indexer(uniq)
+        new = np.flatnonzero(pos < 0)
+        labels = np.empty(len(uniq), dtype=object)
+        labels[pos >= 0] = self.table.values[pos[pos >= 0]]
+        if len(new) > 0:
+            lat, lng = np.asarray(lat), np.asarray(lng)
+            delta = pd.Series(self.locate(lat[first[new]], lng[first[new]]), index=pd.Index(uniq[new]))
+            labels[new] = delta.values
+            self.write(delta)
+            self.table = pd.concat([self.table, delta])
+        print(f'{len(keys)} points at {len(uniq)} coordinates, {len(new)} new coordinates located.')
+        labels[pd.isna(labels)] = np.nan
+        return labels[inverse.ravel()]
@@ -2,7 +2,6 @@ import sys
 from pathlib import Path
 import os
 import pandas as pd
-import sqlalchemy
 import time
 
 
@@ -60,9 +59,7 @@ if __name__ == '__main__':
     top_n = 3
     print(f'Calculating temporal patterns of top {top_n} clusters (weighted):')
     start = time.time()
-    engine = sqlalchemy.create_engine(
-        f'postgresql://{activity_patterns.user}:{activity_patterns.password}'
-        f'@localhost:{activity_patterns.port}/{activity_patterns.db_name}')
+    engine = preprocess.get_engine()
     df_top = pd.read_sql_query(sql="""SELECT * FROM description.clusters_top%s_wt_p;"""%top_n,
                                con=engine)
     activity_patterns.activities_temporal(df_top=df_top)
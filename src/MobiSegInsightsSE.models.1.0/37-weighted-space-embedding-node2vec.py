@@ -4,9 +4,7 @@ os.environ['USE_PYGEOS'] = '0'
 import numpy as np
 import io
 import networkx as nx
-from collections import defaultdict
 import matplotlib.pyplot as plt
-import random
 from tqdm import tqdm
 import tensorflow as tf
 from tensorflow import keras
@@ -16,37 +14,22 @@ ROOT_dir = Path(__file__).parent.parent.parent
 sys.path.append(ROOT_dir)
 sys.path.insert(0, os.path.join(ROOT_dir, 'lib'))
 
+from node2vec import WalkEngine, SkipGramExamples
 
-def next_step(graph, previous, current, p, q):
-    neighbors = list(graph.neighbors(current))
-
-    weights = []
-    # Adjust the weights of the edges to the neighbors with respect to p and q.
-    for neighbor in neighbors:
-        if neighbor == previous:
-            # Control the probability to return to the previous node.
-            weights.append(graph[current][neighbor]["weight"] / p)
-        elif graph.has_edge(neighbor, previous):
-            # The probability of visiting a local node.
-            weights.append(graph[current][neighbor]["weight"])
-        else:
-            # Control the probability to move forward.
-            weights.append(graph[current][neighbor]["weight"] / q)
-
-    # Compute the probabilities of visiting each neighbor.
-    weight_sum = sum(weights)
-    probabilities = [weight / weight_sum for weight in weights]
-    # Probabilistically select a neighbor to visit.
-    next = np.random.choice(neighbors, size=1, p=probabilities)[0]
-    return next
-
-
-def create_dataset(targets, contexts, labels, weights, batch_size):
-    inputs = {
-        "target": targets,
-        "context": contexts,
-    }
-    dataset = tf.data.Dataset.from_tensor_slices((inputs, labels, weights))
+
+def create_dataset(examples, batch_size):
+    # Stream the example chunks from a generator function, called again at every epoch
+    dataset = tf.data.Dataset.from_generator(
+        examples,
+        output_signature=(
+            tf.TensorSpec(shape=(None,), dtype=tf.int32),
+            tf.TensorSpec(shape=(None,), dtype=tf.int32),
+            tf.TensorSpec(shape=(None,), dtype=tf.int32),
+            tf.TensorSpec(shape=(None,), dtype=tf.float32),
+        ),
+    )
+    dataset = dataset.map(lambda t, c, l, w: ({"target": t, "context": c}, l, w))
+    dataset = dataset.unbatch()
     dataset = dataset.shuffle(buffer_size=batch_size * 2)
     dataset = dataset.batch(batch_size, drop_remainder=True)
     dataset = dataset.prefetch(tf.data.AUTOTUNE)
@@ -70,68 +53,18 @@ class WeightedNode2Vec:
         self.vocabulary = ["NA"] + list(self.G.nodes)
         self.vocabulary_lookup = {token: idx for idx, token in enumerate(self.vocabulary)}
 
-    def random_walk(self, num_walks, num_steps, p, q):
-        self.walks = []
-        nodes = list(self.G.nodes())
-        # Perform multiple iterations of the random walk.
-        for walk_iteration in range(num_walks):
-            random.shuffle(nodes)
-
-            for node in tqdm(
-                nodes,
-                position=0,
-                leave=True,
-                desc=f"Random walks iteration {walk_iteration + 1} of {num_walks}",
-            ):
-                # Start the walk with a random node from the graph.
-                walk = [node]
-                # Randomly walk for num_steps.
-                while len(walk) < num_steps:
-                    current = walk[-1]
-                    previous = walk[-2] if len(walk) > 1 else None
-                    # Compute the next node to visit.
-                    next = next_step(self.G, previous, current, p, q)
-                    walk.append(next)
-                # Replace node ids (movie ids) in the walk with token ids.
-                walk = [self.vocabulary_lookup[token] for token in walk]
-                # Add the walk to the generated sequence.
-                self.walks.append(walk)
-
-    def generate_examples(self, window_size, num_negative_samples, vocabulary_size):
-        example_weights = defaultdict(int)
-        # Iterate over all sequences (walks).
-        for sequence in tqdm(
-            self.walks,
-            position=0,
-            leave=True,
-            desc=f"Generating postive and negative examples",
-        ):
-            # Generate positive and negative skip-gram pairs for a sequence (walk).
-            pairs, labels = keras.preprocessing.sequence.skipgrams(
-                sequence,
-                vocabulary_size=vocabulary_size,
-                window_size=window_size,
-                negative_samples=num_negative_samples,
-            )
-            for idx in range(len(pairs)):
-                pair = pairs[idx]
-                label = labels[idx]
-                target, context = min(pair[0], pair[1]), max(pair[0], pair[1])
-                if target == context:
-                    continue
-                entry = (target, context, label)
-                example_weights[entry] += 1
-
-        targets, contexts, labels, weights = [], [], [], []
-        for entry in example_weights:
-            weight = example_weights[entry]
-            target, context, label = entry
-            targets.append(target)
-            contexts.append(context)
-            labels.append(label)
-            weights.append(weight)
-
-        return np.array(targets), np.array(contexts), np.array(labels), np.array(weights)
+    def random_walk(self, num_walks, num_steps, p, q, seed=0, num_cpus=1):
+        # Biased random walks from every node, num_walks times
+        engine = WalkEngine(self.G, weight='weight')
+        walks = engine.random_walks(num_walks, num_steps, p=p, q=q, seed=seed, num_cpus=num_cpus)
+        # Replace node positions in the walks with token ids ("NA" is 0).
+        token_ids = np.array([self.vocabulary_lookup[token] for token in engine.nodes], dtype=np.int32)
+        self.walks = token_ids[walks]
+
+    def generate_examples(self, window_size, num_negative_samples, vocabulary_size, chunk_size=10000, seed=0):
+        # Positive and negative skip-gram examples, produced chunk by chunk of walks
+        return SkipGramExamples(self.walks, vocabulary_size=vocabulary_size, window_size=window_size,
+                                num_negative_samples=num_negative_samples, chunk_size=chunk_size, seed=seed)
 
     def create_model(self, embedding_dim):
         vocabulary_size = len(self.vocabulary)
@@ -172,30 +105,28 @@ if __name__ == '__main__':
     num_walks = 10
     # Number of steps of each random walk.
     num_steps = 20
-    wn.random_walk(num_walks, num_steps, p, q)
+    wn.random_walk(num_walks, num_steps, p, q, seed=0, num_cpus=8)
     print("Number of walks generated:", len(wn.walks))
 
     print('Generate positive and negative examples.')
     num_negative_samples = 1
-    targets, contexts, labels, weights = wn.generate_examples(
+    examples = wn.generate_examples(
         window_size=num_steps,
         num_negative_samples=num_negative_samples,
         vocabulary_size=len(wn.vocabulary),
     )
-    print(f"Targets shape: {targets.shape}")
-    print(f"Contexts shape: {contexts.shape}")
-    print(f"Labels shape: {labels.shape}")
-    print(f"Weights shape: {weights.shape}")
+    print(f"Number of example chunks: {len(examples)}")
 
     print('Convert the data into tf.data.Dataset objects.')
     batch_size = 1024
-    dataset = create_dataset(
-        targets=targets,
-        contexts=contexts,
-        labels=labels,
-        weights=weights,
-        batch_size=batch_size,
-    )
+    # Write the examples to disk shards to train on graphs whose examples do not fit in memory
+    use_shards = False
+    if use_shards:
+        shard_dir = examples.save_shards(os.path.join(ROOT_dir, "dbs/graphs/skipgram_shards_poi"))
+        dataset = create_dataset(lambda: SkipGramExamples.read_shards(shard_dir, len(examples)),
+                                 batch_size=batch_size)
+    else:
+        dataset = create_dataset(lambda: iter(examples), batch_size=batch_size)
 
     print('Train the skip-gram model.')
     learning_rate = 0.001